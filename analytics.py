@@ -0,0 +1,182 @@
+import argparse
+import csv
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+
+# ============================================
+# تصدير التحليلات (Analytics Export)
+# ============================================
+# كل القراءات تتم على نسخة منسوخة عبر Online Backup API، وليس على قاعدة البيانات الحية،
+# حتى لا يرى البوت أي معاملة قراءة طويلة من التحليلات. البوت يفعّل WAL على قاعدة البيانات،
+# فتُنسخ اللقطة في خطوة واحدة داخل معاملة قراءة لا توقف الكتابات.
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("analytics")
+
+DEFAULT_DB = os.getenv("DB_FILE", "shard_game.db")
+DEFAULT_OUT = os.getenv("EXPORT_DIR", "exports")
+CHUNK_ROWS = 50000             # عدد الصفوف في كل ملف مُصدَّر
+
+HISTORY_COLUMNS = ["id", "user_id", "part_id", "choice_text", "impact_summary", "timestamp"]
+# ملاحظة: ترحيل معرفات الأجزاء (/ترحيل_القصة) يعيد كتابة history.part_id في قاعدة البيانات فقط؛
+# الصفوف المُصدَّرة قبله تبقى في ملفات history بمعرفاتها القديمة، ولا يُعاد تصديرها
+# (العلامة على id). اللاعبون المُرحَّلون يُصدَّرون من جديد لأن last_updated يُحدَّث معهم.
+
+
+def snapshot_database(live_db: str, dest: str) -> str:
+    """نسخة متسقة من قاعدة البيانات الحية في خطوة واحدة عبر sqlite3 backup.
+    النسخ على خطوات يُعاد من البداية كلما كتب اتصال آخر، وقد لا ينتهي أبداً على بوت نشط"""
+    src = sqlite3.connect(f"file:{live_db}?mode=ro", uri=True, timeout=10)
+    dst = sqlite3.connect(dest)
+    try:
+        if src.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+            logger.warning("⚠️ قاعدة البيانات ليست في وضع WAL؛ ستتوقف كتابات البوت أثناء النسخ (شغّل البوت مرة لتفعيله)")
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+    logger.info(f"📸 تم أخذ لقطة من {live_db}")
+    return dest
+
+
+def load_watermark(out_dir: str) -> Dict:
+    try:
+        with open(os.path.join(out_dir, "watermark.json"), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"history_id": 0, "players_updated_at": ""}
+
+
+def save_watermark(out_dir: str, watermark: Dict):
+    path = os.path.join(out_dir, "watermark.json")
+    tmp = path + ".tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(watermark, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def _chunks(cursor: sqlite3.Cursor) -> Iterator[List]:
+    while True:
+        rows = cursor.fetchmany(CHUNK_ROWS)
+        if not rows:
+            return
+        yield rows
+
+
+def export_history(conn: sqlite3.Connection, out_dir: str, since_id: int) -> int:
+    """تصدير صفوف history الجديدة كملفات CSV مضغوطة، ويعيد آخر معرف مُصدَّر"""
+    os.makedirs(os.path.join(out_dir, "history"), exist_ok=True)
+    c = conn.cursor()
+    c.execute(f"SELECT {', '.join(HISTORY_COLUMNS)} FROM history WHERE id > ? ORDER BY id", (since_id,))
+    last_id = since_id
+    for rows in _chunks(c):
+        first_id, last_id = rows[0][0], rows[-1][0]
+        path = os.path.join(out_dir, "history", f"history_{first_id:012d}_{last_id:012d}.csv.gz")
+        with gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(HISTORY_COLUMNS)
+            writer.writerows(rows)
+        logger.info(f"📤 {len(rows)} صف من history -> {path}")
+    return last_id
+
+
+def export_players(conn: sqlite3.Connection, out_dir: str, since: str) -> str:
+    """تصدير اللاعبين الذين تغيروا منذ آخر علامة كملفات JSONL مضغوطة"""
+    os.makedirs(os.path.join(out_dir, "players"), exist_ok=True)
+    c = conn.cursor()
+    c.execute("SELECT * FROM players WHERE last_updated > ? ORDER BY last_updated", (since,))
+    columns = [d[0] for d in c.description]
+    latest = since
+    stamp = datetime.now().strftime("%Y%m%dT%H%M%S")
+    for n, rows in enumerate(_chunks(c)):
+        path = os.path.join(out_dir, "players", f"players_{stamp}_{n:04d}.jsonl.gz")
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            for row in rows:
+                record = {k: (v.hex() if isinstance(v, bytes) else v) for k, v in zip(columns, row)}
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        latest = rows[-1][columns.index("last_updated")] or latest
+        logger.info(f"📤 {len(rows)} لاعب -> {path}")
+    return latest
+
+
+def run_export(live_db: str, out_dir: str):
+    os.makedirs(out_dir, exist_ok=True)
+    watermark = load_watermark(out_dir)
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot = snapshot_database(live_db, os.path.join(tmp, "snapshot.db"))
+        conn = sqlite3.connect(snapshot)
+        try:
+            watermark["history_id"] = export_history(conn, out_dir, watermark.get("history_id", 0))
+            watermark["players_updated_at"] = export_players(conn, out_dir, watermark.get("players_updated_at", ""))
+        finally:
+            conn.close()
+    watermark["exported_at"] = datetime.now().isoformat()
+    save_watermark(out_dir, watermark)
+    logger.info(f"✅ اكتمل التصدير حتى history.id = {watermark['history_id']}")
+
+
+def iter_history(out_dir: str) -> Iterator[Dict]:
+    history_dir = os.path.join(out_dir, "history")
+    if not os.path.isdir(history_dir):
+        return
+    for name in sorted(os.listdir(history_dir)):
+        if not name.endswith(".csv.gz"):
+            continue
+        with gzip.open(os.path.join(history_dir, name), 'rt', encoding='utf-8', newline='') as f:
+            yield from csv.DictReader(f)
+
+
+def choice_distribution(out_dir: str) -> Dict[str, Counter]:
+    """توزيع الخيارات لكل جزء، محسوب من الملفات المُصدَّرة فقط"""
+    distribution: Dict[str, Counter] = defaultdict(Counter)
+    for row in iter_history(out_dir):
+        distribution[row["part_id"]][row["choice_text"]] += 1
+    return distribution
+
+
+def run_report(out_dir: str, top: Optional[int] = None):
+    distribution = choice_distribution(out_dir)
+    os.makedirs(os.path.join(out_dir, "reports"), exist_ok=True)
+    path = os.path.join(out_dir, "reports", "choice_distribution.csv")
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["part_id", "choice_text", "count", "share"])
+        for part_id in sorted(distribution):
+            counts = distribution[part_id]
+            total = sum(counts.values())
+            for choice_text, count in counts.most_common():
+                writer.writerow([part_id, choice_text, count, f"{count / total:.4f}"])
+    logger.info(f"📊 تم كتابة التقرير: {path}")
+
+    busiest = sorted(distribution.items(), key=lambda kv: sum(kv[1].values()), reverse=True)
+    for part_id, counts in busiest[:top]:
+        total = sum(counts.values())
+        summary = " | ".join(f"{text} {count / total:.0%}" for text, count in counts.most_common())
+        print(f"{part_id} ({total}): {summary}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="تصدير وتحليل قرارات اللاعبين دون المساس بقاعدة البيانات الحية")
+    sub = parser.add_subparsers(dest="command", required=True)
+    export = sub.add_parser("export", help="أخذ لقطة وتصدير الصفوف الجديدة منذ آخر علامة")
+    export.add_argument("--db", default=DEFAULT_DB)
+    export.add_argument("--out", default=DEFAULT_OUT)
+    report = sub.add_parser("report", help="حساب توزيع الخيارات لكل جزء من الملفات المُصدَّرة")
+    report.add_argument("--out", default=DEFAULT_OUT)
+    report.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        run_export(args.db, args.out)
+    else:
+        run_report(args.out, args.top)
+
+
+if __name__ == "__main__":
+    main()
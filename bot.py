@@ -1,5 +1,5 @@
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import app_commands
 import json
 import os
@@ -7,23 +7,116 @@ import sqlite3
 import random
 import logging
 import asyncio
+import atexit
+import gzip
+import hashlib
+import hmac
+import io
+import math
+import queue
+import shutil
+import sys
+import threading
+import time
+import traceback
+import weakref
+import zlib
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
 from datetime import datetime, timedelta
 from typing import Dict, List, Any, Optional
-from flask import Flask
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+from flask import Flask, Response, jsonify, request
 from threading import Thread
 
 # ============================================
 # إعدادات تسجيل الأخطاء (Logging)
 # ============================================
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("game_log.txt", encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+# الكتابة على القرص تتم في خيط خلفي (QueueListener) حتى لا تُوقف حلقة الأحداث
+LOG_FILE = os.getenv("LOG_FILE", "game_log.txt")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN")  # مثل "midnight" للتدوير الزمني بدلاً من الحجم
+# نسبة العينات لكل مسجل عالي الحجم (1.0 = كل السجلات)
+LOG_SAMPLING = {
+    "shard.clicks": float(os.getenv("CLICK_LOG_SAMPLE", "1.0")),
+}
+
+class JsonLineFormatter(logging.Formatter):
+    """تنسيق السجل كسطر JSON واحد مع الحقول المهيكلة الإضافية"""
+    EXTRA_FIELDS = ("user", "part", "choice", "result", "success", "mode", "ack_ms", "latency_ms")
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in self.EXTRA_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class SamplingFilter(logging.Filter):
+    """يمرر نسبة فقط من سجلات المسجل (للأحداث عالية الحجم مثل النقرات)"""
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+class DeferredQueueHandler(QueueHandler):
+    """يضع السجل في الطابور كما هو؛ التنسيق يتم في خيط الكتابة وليس في حلقة الأحداث"""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+def _gzip_rotator(source: str, dest: str):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+def setup_logging() -> QueueListener:
+    if LOG_ROTATE_WHEN:
+        file_handler = TimedRotatingFileHandler(LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    else:
+        file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    file_handler.namer = lambda name: name + ".gz"
+    file_handler.rotator = _gzip_rotator
+    file_handler.setFormatter(JsonLineFormatter())
+    
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    
+    for name, rate in LOG_SAMPLING.items():
+        if rate < 1.0:
+            logging.getLogger(name).addFilter(SamplingFilter(rate))
+    
+    listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
+click_logger = logging.getLogger("shard.clicks")
+
+# ============================================
+# إعدادات مزامنة الأوامر
+# ============================================
+COMMAND_SYNC_STATE_FILE = os.getenv("COMMAND_SYNC_STATE_FILE", "command_sync.json")
+DEV_GUILD_ID = os.getenv("DEV_GUILD_ID")  # مزامنة سريعة على سيرفر واحد أثناء التطوير
+FORCE_COMMAND_SYNC = os.getenv("FORCE_COMMAND_SYNC", "0") == "1"
 
 # ============================================
 # إعدادات الصلاحيات (Intents)
@@ -42,6 +135,39 @@ app = Flask('')
 def home():
     return "I am alive!"
 
+def _authorized() -> bool:
+    """الرمز يُرسل في رأس X-Profile-Token (لا في الرابط حتى لا يظهر في سجلات الوصول) ويُقارن بزمن ثابت"""
+    token = request.headers.get("X-Profile-Token", "")
+    return bool(PROFILE_TOKEN) and hmac.compare_digest(token.encode('utf-8'), PROFILE_TOKEN.encode('utf-8'))
+
+@app.route('/admission')
+def admission_endpoint():
+    """عدادات القبول والرفض (محمي بـ PROFILE_TOKEN)"""
+    if not _authorized():
+        return "forbidden", 403
+    return jsonify(admission.stats())
+
+@app.route('/profile')
+def profile_endpoint():
+    """تشغيل محلل الأداء لعدد من الثواني (محمي بـ PROFILE_TOKEN)"""
+    if not _authorized():
+        return "forbidden", 403
+    try:
+        seconds = float(request.args.get("seconds", 10))
+    except ValueError:
+        return "seconds must be a number", 400
+    if not math.isfinite(seconds):
+        return "seconds must be a number", 400
+    seconds = min(max(seconds, 1), PROFILE_MAX_SECONDS)
+    if not profiler.ready:
+        return "profiler not ready (bot still starting)", 503
+    stacks = profiler.run(seconds)
+    if stacks is None:
+        return "profiler already running", 409
+    if request.args.get("format") == "collapsed":
+        return Response(SamplingProfiler.collapsed(stacks), mimetype="text/plain")
+    return Response(SamplingProfiler.summary(stacks), mimetype="text/plain")
+
 def run():
     app.run(host='0.0.0.0', port=8080)
 
@@ -50,15 +176,236 @@ def keep_alive():
     t.daemon = True
     t.start()
 
+# ============================================
+# تشخيص الأداء (Profiler & Stall Detector)
+# ============================================
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")  # بدونه تبقى نقطة /profile معطلة
+PROFILE_MAX_SECONDS = 120
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD_MS", "250")) / 1000
+# المسارات الساخنة التي يُعرض نصيبها دائماً في الملخص
+PROFILE_HOT_PATHS = ("StoryView.", "Database.", "ShardBot.create_game_embed", "ChoiceEngine.")
+IDLE_FUNCTIONS = {"select", "poll", "epoll", "kqueue", "_run_once"}
+# خيوط المنفذ الافتراضي لحلقة الأحداث (asyncio.to_thread)؛ تُعاين مع خيط الحلقة
+WORKER_THREAD_PREFIX = "shard-worker"
+WORKER_STACK_ROOT = "[worker]"
+IDLE_WORKER_FUNCTIONS = {"_worker", "wait"}
+
+class SamplingProfiler:
+    """محلل بأخذ العينات: خيط خلفي يقرأ مكدس خيط حلقة الأحداث كل بضعة ميلي ثوانٍ،
+    فلا يضيف أي كلفة على الكود نفسه ولا يحتاج لإعادة التشغيل.
+    خيوط العمال (عمل قاعدة البيانات للنقرات) تُعاين أيضاً وهي مشغولة فقط، تحت جذر [worker]"""
+    
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.target_thread: Optional[int] = None
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _frame_name(frame) -> str:
+        code = frame.f_code
+        return f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}"
+    
+    def _collapse(self, frame) -> str:
+        names = []
+        while frame is not None:
+            names.append(self._frame_name(frame))
+            frame = frame.f_back
+        return ";".join(reversed(names))
+    
+    @property
+    def ready(self) -> bool:
+        """خيط حلقة الأحداث معروف (يُضبط في setup_hook)"""
+        return self.target_thread is not None
+    
+    def run(self, seconds: float) -> Optional[Counter]:
+        """يأخذ العينات لمدة محددة (دالة حاجبة تُستدعى من خيط آخر). يعيد None إن كان يعمل مسبقاً"""
+        if not self.ready:
+            raise RuntimeError("profiler target thread is not set yet")
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            stacks = Counter()
+            sampler = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                frames = sys._current_frames()
+                frame = frames.get(self.target_thread)
+                if frame is not None:
+                    stacks[self._collapse(frame)] += 1
+                for thread in threading.enumerate():
+                    # المحلل نفسه يعمل غالباً في خيط عامل (asyncio.to_thread)
+                    if not thread.name.startswith(WORKER_THREAD_PREFIX) or thread.ident == sampler:
+                        continue
+                    frame = frames.get(thread.ident)
+                    if frame is not None and frame.f_code.co_name not in IDLE_WORKER_FUNCTIONS:
+                        stacks[f"{WORKER_STACK_ROOT};{self._collapse(frame)}"] += 1
+                time.sleep(self.interval)
+            return stacks
+        finally:
+            self._lock.release()
+    
+    @staticmethod
+    def collapsed(stacks: Counter) -> str:
+        """صيغة collapsed-stack المتوافقة مع flamegraph.pl و speedscope"""
+        return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+    
+    @staticmethod
+    def summary(stacks: Counter, top: int = 15) -> str:
+        total = sum(stacks.values())
+        if not total:
+            return "لا توجد عينات."
+        own, inclusive = Counter(), Counter()
+        idle = worker = 0
+        for stack, count in stacks.items():
+            frames = stack.split(";")
+            if frames[0] == WORKER_STACK_ROOT:
+                worker += count
+            else:
+                leaf = frames[-1].split(":", 1)[-1]
+                if leaf.rsplit(".", 1)[-1] in IDLE_FUNCTIONS:
+                    idle += count
+                    continue
+            own[frames[-1]] += count
+            for name in set(frames):
+                inclusive[name] += count
+        loop_total = (total - worker) or 1
+        lines = [f"عينات الحلقة: {total - worker} • خمول الحلقة: {idle / loop_total:.0%} • انشغال: {1 - idle / loop_total:.0%}"
+                 f" • عينات العمال المشغولة: {worker}", "", "الأعلى (ذاتي):"]
+        lines += [f"{count / total:6.1%}  {name}" for name, count in own.most_common(top)]
+        lines += ["", "المسارات الساخنة (شامل):"]
+        hot = [(n, c) for n, c in inclusive.items() if any(p in n for p in PROFILE_HOT_PATHS)]
+        lines += [f"{count / total:6.1%}  {name}" for name, count in sorted(hot, key=lambda nc: nc[1], reverse=True)[:top]]
+        return "\n".join(lines)
+
+class LoopStallDetector:
+    """يكتشف أي استدعاء يحجز حلقة الأحداث أطول من الحد، ويسجل مكدسه لحظة الحجز"""
+    
+    def __init__(self, threshold: float = LOOP_STALL_THRESHOLD):
+        self.threshold = threshold
+        self.last_beat = time.monotonic()
+        self.loop_thread: Optional[int] = None
+    
+    def start(self):
+        """يُستدعى من داخل حلقة الأحداث"""
+        self.loop_thread = threading.get_ident()
+        asyncio.get_running_loop().create_task(self._heartbeat())
+        Thread(target=self._watch, name="loop-stall-watchdog", daemon=True).start()
+    
+    async def _heartbeat(self):
+        while True:
+            self.last_beat = time.monotonic()
+            await asyncio.sleep(self.threshold / 4)
+    
+    def _watch(self):
+        reported_beat = None
+        while True:
+            time.sleep(self.threshold / 2)
+            beat = self.last_beat
+            lag = time.monotonic() - beat
+            if lag > self.threshold and beat != reported_beat:
+                reported_beat = beat
+                frame = sys._current_frames().get(self.loop_thread)
+                stack = "".join(traceback.format_stack(frame)) if frame else "?"
+                logger.warning("🐢 حلقة الأحداث محجوزة منذ %.0f ms:\n%s", lag * 1000, stack)
+
+profiler = SamplingProfiler()
+stall_detector = LoopStallDetector()
+
 # ============================================
 # محمل القصة (Story Loader)
 # ============================================
+# اختياري (فارغ افتراضياً): مثل "retro_p02_b.json,retro_p03_a.json,retro_p03_b.json"
+# بالترتيب: يُربط كل قوس بنهايات القوس الذي قبله، وأول قوس بجزء ARC_ENTRY_PART من القصة الرئيسية،
+# ونهايات آخر قوس تعود إلى PART_01. (retro_p02_a.json ليس JSON صالحاً حالياً)
+ARC_FILES = [f for f in os.getenv("ARC_FILES", "").split(",") if f]
+ARC_ENTRY_PART = os.getenv("ARC_ENTRY_PART", "PART_END")
+
 class StoryLoader:
     """يتعامل مع ملف القصة JSON ويقوم بتحليل البيانات بشكل متقدم"""
     
-    def __init__(self, story_file: str = "story.json"):
+    def __init__(self, story_file: str = "story.json", arc_files: Optional[List[str]] = None):
         self.story_file = story_file
         self.data = self.load_story()
+        self.load_arcs(ARC_FILES if arc_files is None else arc_files)
+        self.compile()
+    
+    def load_arcs(self, arc_files: List[str]):
+        """دمج ملفات الأقواس الإضافية (مثل retro_*) بصيغتها الخاصة في أجزاء القصة، وربطها بالقصة كسلسلة"""
+        parts = self.data.setdefault("parts", {})
+        exits = [ARC_ENTRY_PART]  # الأجزاء التي ستقود إلى بداية القوس التالي
+        for arc_file in arc_files:
+            if not os.path.exists(arc_file):
+                continue
+            try:
+                with open(arc_file, 'r', encoding='utf-8') as f:
+                    arc = json.load(f)
+            except Exception as e:
+                logger.error(f"⚠️ خطأ في تحميل القوس {arc_file}: {e}")
+                continue
+            arc_parts = arc.get("parts", [])
+            if isinstance(arc_parts, dict):
+                arc_parts = list(arc_parts.values())
+            for part in arc_parts:
+                part = dict(part)
+                part["choices"] = [
+                    {**c, "next": c.get("next", c.get("next_part_id"))} for c in part.get("choices", [])
+                ]
+                parts.setdefault(part["id"], part)
+            
+            metadata = arc.get("metadata", {})
+            start = metadata.get("start_part_id")
+            if start in parts:
+                for exit_id in exits:
+                    exit_part = parts.get(exit_id)
+                    if exit_part is not None:
+                        exit_part["choices"] = list(exit_part.get("choices", [])) + [
+                            {"text": f"▶️ تابع: {metadata.get('title', start)}"[:80], "emoji": "▶️", "next": start, "effects": {}}
+                        ]
+                exits = [p["id"] for p in arc_parts if p.get("ending")]
+            else:
+                logger.warning(f"⚠️ القوس {arc_file} بلا start_part_id صالح، لن يُربط بالقصة")
+            logger.info(f"✅ تم تحميل القوس: {metadata.get('title', arc_file)} ({len(arc_parts)} جزء)")
+        
+        # نهايات آخر قوس بلا خيارات؛ بدون هذا يعلق اللاعب في جزء بلا أزرار
+        if exits != [ARC_ENTRY_PART]:
+            for exit_id in exits:
+                exit_part = parts[exit_id]
+                if not exit_part.get("choices"):
+                    exit_part["choices"] = [{"text": "🔄 ابدأ الرحلة من جديد", "emoji": "🔄", "next": "PART_01", "effects": {}}]
+    
+    def compile(self):
+        """بناء الفهارس المشتقة من القصة مرة واحدة عند التحميل"""
+        flag_names = set()
+        for part in self.data.get("parts", {}).values():
+            for choice in part.get("choices", []):
+                for block in (choice.get("effects", {}), choice.get("fail_effects", {}), choice.get("require", {})):
+                    if "flag" in block:
+                        flag_names.add(block["flag"])
+        # ترتيب ثابت حتى تُسجَّل الأعلام الجديدة بنفس الترتيب في كل تشغيل
+        self.flag_names = sorted(flag_names)
+        
+        # رسم المواقع: كل موقع عقدة، وكل انتقال بين جزأين في موقعين مختلفين حافة
+        parts = self.data.get("parts", {})
+        self.locations: List[str] = []
+        edges: Dict[str, set] = {}
+        for part in parts.values():
+            location = part.get("location")
+            if not location:
+                continue
+            if location not in edges:
+                self.locations.append(location)
+                edges[location] = set()
+            for choice in part.get("choices", []):
+                for target_id in (choice.get("next"), choice.get("fail_next")):
+                    target = parts.get(target_id) or {}
+                    target_location = target.get("location")
+                    if target_location and target_location != location:
+                        edges[location].add(target_location)
+        order = {name: i for i, name in enumerate(self.locations)}
+        self.location_graph: Dict[str, List[str]] = {
+            name: sorted(neighbours, key=lambda n: order.get(n, len(order))) for name, neighbours in edges.items()
+        }
     
     def load_story(self) -> Dict:
         try:
@@ -106,6 +453,25 @@ class StoryLoader:
             }
         }
     
+    def load_migrations(self, migrations_file: str) -> Optional[Dict]:
+        """ملف التحويل: {"version": "...", "mappings": {"OLD_PART": "NEW_PART", ...}}"""
+        if not os.path.exists(migrations_file):
+            return None
+        with open(migrations_file, 'r', encoding='utf-8') as f:
+            migration = json.load(f)
+        mappings = migration.get("mappings", {})
+        errors = []
+        if not str(migration.get("version") or "").strip():
+            # بلا إصدار لا يمكن تمييز الملفات عن بعضها في story_migrations
+            errors.append("ملف التحويل بلا `version`")
+        for old, new in mappings.items():
+            if new not in self.data.get("parts", {}):
+                errors.append(f"`{old}` → `{new}`: الجزء الجديد غير موجود في القصة")
+            elif new in mappings:
+                errors.append(f"`{old}` → `{new}`: الهدف نفسه مُحوَّل (سلسلة تحويلات)")
+        migration["errors"] = errors
+        return migration
+    
     def get_part(self, part_id: str) -> Optional[Dict]:
         part = self.data.get("parts", {}).get(part_id)
         if part:
@@ -124,9 +490,20 @@ class StoryLoader:
 # ============================================
 # قاعدة البيانات المتكاملة (Database) - محسنة
 # ============================================
+SAVE_SLOTS = 3            # خانات الحفظ اليدوية (1..3)
+AUTOSAVE_SLOT = 0         # نسخة تلقائية قبل إعادة التعيين
+PARTY_SLOT = SAVE_SLOTS + 1  # الحالة الفردية قبل الانضمام لرحلة جماعية
+SAVE_HISTORY_LIMIT = 50   # عدد القرارات الأخيرة المحفوظة مع اللقطة
+SAVE_FORMAT_VERSION = 3   # 3: صفوف history تحمل معرفاتها الأصلية مع history_id للقطة
+BITSET_COLUMNS = ("flags_bitset", "visited_locations")  # أعمدة BLOB تُحفظ كـ hex داخل اللقطات
+STORY_MIGRATIONS_FILE = os.getenv("STORY_MIGRATIONS_FILE", "story_migrations.json")
+MIGRATION_BATCH_PAUSE = 0.01  # ثوانٍ بين دفعات الترحيل ليتمكن البوت من الكتابة
+
 class Database:
     def __init__(self, db_file: str = "shard_game.db"):
         self.db_file = db_file
+        # قواميس مواقع البتات مشتركة بين حلقة الأحداث وخيوط العمال
+        self._bits_lock = threading.RLock()
         self.init_db()
     
     def _get_connection(self):
@@ -137,6 +514,9 @@ class Database:
         conn = self._get_connection()
         c = conn.cursor()
         
+        # WAL (إعداد دائم في الملف): القراءات الطويلة مثل لقطة التحليلات لا توقف كتابات البوت
+        c.execute("PRAGMA journal_mode=WAL")
+        
         # جدول اللاعبين بكل المتغيرات الموجودة في القصة
         c.execute('''CREATE TABLE IF NOT EXISTS players (
             user_id INTEGER PRIMARY KEY,
@@ -153,8 +533,16 @@ class Database:
             knowledge_path INTEGER DEFAULT 0,
             location TEXT DEFAULT 'أنقاض',
             last_daily TEXT,
-            last_updated TEXT
+            last_updated TEXT,
+            flags_bitset BLOB DEFAULT x'',
+            relationships TEXT DEFAULT '{}',
+            traits TEXT DEFAULT '{}',
+            visited_locations BLOB DEFAULT x''
         )''')
+        self._ensure_column(c, "players", "flags_bitset", "BLOB DEFAULT x''")
+        self._ensure_column(c, "players", "relationships", "TEXT DEFAULT '{}'")
+        self._ensure_column(c, "players", "traits", "TEXT DEFAULT '{}'")
+        self._ensure_column(c, "players", "visited_locations", "BLOB DEFAULT x''")
         
         c.execute('''CREATE TABLE IF NOT EXISTS achievements (
             user_id INTEGER,
@@ -171,12 +559,22 @@ class Database:
             PRIMARY KEY (user_id, item_id)
         )''')
         
-        c.execute('''CREATE TABLE IF NOT EXISTS flags (
-            user_id INTEGER,
-            flag_name TEXT,
-            flag_value INTEGER DEFAULT 1,
-            PRIMARY KEY (user_id, flag_name)
+        # فهرسة الأعلام: كل اسم علم يأخذ موقع بت ثابتاً لا يتغير (إضافة فقط)
+        c.execute('''CREATE TABLE IF NOT EXISTS flag_bits (
+            flag_name TEXT PRIMARY KEY,
+            bit INTEGER UNIQUE
+        )''')
+        c.execute("SELECT flag_name, bit FROM flag_bits")
+        self.flag_bits = {name: bit for name, bit in c.fetchall()}
+        
+        # نفس الفكرة لمجموعة المواقع المزارة لكل لاعب
+        c.execute('''CREATE TABLE IF NOT EXISTS location_bits (
+            location TEXT PRIMARY KEY,
+            bit INTEGER UNIQUE
         )''')
+        c.execute("SELECT location, bit FROM location_bits")
+        self.location_bits = {name: bit for name, bit in c.fetchall()}
+        self._migrate_flag_rows(c)
         
         c.execute('''CREATE TABLE IF NOT EXISTS history (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -187,8 +585,170 @@ class Database:
             timestamp TEXT
         )''')
         
+        c.execute("CREATE INDEX IF NOT EXISTS idx_history_user ON history (user_id, id)")
+        
+        # خانات الحفظ: لقطة مضغوطة واحدة لكل (لاعب، خانة)
+        c.execute('''CREATE TABLE IF NOT EXISTS save_slots (
+            user_id INTEGER,
+            slot INTEGER,
+            part_id TEXT,
+            saved_at TEXT,
+            data BLOB,
+            PRIMARY KEY (user_id, slot)
+        )''')
+        
+        # إصدارات ترحيل معرفات الأجزاء المطبقة
+        c.execute('''CREATE TABLE IF NOT EXISTS story_migrations (
+            version TEXT PRIMARY KEY,
+            applied_at TEXT,
+            players INTEGER,
+            history INTEGER
+        )''')
+        # حجز بلا نتيجة (players IS NULL) بقي من تطبيق انقطع بإعادة تشغيل؛ لا تطبيق يجري عند البدء،
+        # والتحويل قابل للإعادة بأمان
+        c.execute("DELETE FROM story_migrations WHERE players IS NULL")
+        
+        # روابط الصور المرفوعة إلى قناة التخزين
+        c.execute('''CREATE TABLE IF NOT EXISTS assets (
+            name TEXT PRIMARY KEY,
+            file_hash TEXT,
+            message_id INTEGER,
+            attachment_id INTEGER,
+            url TEXT,
+            expires_at TEXT,
+            updated_at TEXT
+        )''')
+        
+        # عدادات الإنجازات: تُحدّث مع كل فتح/إعادة تعيين بدلاً من COUNT(*) GROUP BY
+        c.execute('''CREATE TABLE IF NOT EXISTS achievement_stats (
+            achievement_id TEXT PRIMARY KEY,
+            unlock_count INTEGER DEFAULT 0,
+            first_user_id INTEGER,
+            first_unlocked_at TEXT
+        )''')
+        
+        # ملء العدادات مرة واحدة من البيانات القديمة
+        c.execute("SELECT COUNT(*) FROM achievement_stats")
+        if c.fetchone()[0] == 0:
+            c.execute('''INSERT INTO achievement_stats (achievement_id, unlock_count, first_user_id, first_unlocked_at)
+                         SELECT a.achievement_id, COUNT(*), 
+                                (SELECT user_id FROM achievements f WHERE f.achievement_id = a.achievement_id ORDER BY unlocked_at LIMIT 1),
+                                MIN(a.unlocked_at)
+                         FROM achievements a GROUP BY a.achievement_id''')
+        
+        c.execute("PRAGMA table_info(players)")
+        self.player_columns = {r[1] for r in c.fetchall()}
+        
         conn.commit()
         conn.close()
+        self.refresh_achievement_snapshot()
+    
+    def _ensure_column(self, c: sqlite3.Cursor, table: str, column: str, decl: str):
+        c.execute(f"PRAGMA table_info({table})")
+        if column not in {r[1] for r in c.fetchall()}:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    
+    # ---------- الأعلام والعلاقات (Flags) ----------
+    def _intern_bit(self, c: sqlite3.Cursor, table: str, column: str, bits: Dict[str, int], name: str) -> int:
+        with self._bits_lock:
+            bit = bits.get(name)
+            if bit is None:
+                bit = len(bits)
+                c.execute(f"INSERT INTO {table} ({column}, bit) VALUES (?, ?)", (name, bit))
+                bits[name] = bit
+            return bit
+    
+    def _flag_bit(self, c: sqlite3.Cursor, flag_name: str) -> int:
+        return self._intern_bit(c, "flag_bits", "flag_name", self.flag_bits, flag_name)
+    
+    def _register_bits(self, table: str, column: str, bits: Dict[str, int], names: List[str]):
+        if all(name in bits for name in names):
+            return
+        with self._bits_lock:
+            conn = self._get_connection()
+            c = conn.cursor()
+            for name in names:
+                self._intern_bit(c, table, column, bits, name)
+            conn.commit()
+            conn.close()
+    
+    def register_flags(self, flag_names: List[str]):
+        """تسجيل أسماء الأعلام المجمعة من القصة وإعطاء الجديد منها مواقع بت"""
+        self._register_bits("flag_bits", "flag_name", self.flag_bits, flag_names)
+    
+    def register_locations(self, locations: List[str]):
+        """تسجيل مواقع القصة كمواقع بت ثابتة لمجموعة المواقع المزارة"""
+        self._register_bits("location_bits", "location", self.location_bits, locations)
+    
+    def with_location(self, player: Dict, location: str) -> bytes:
+        """إرجاع قيمة visited_locations الجديدة بعد إضافة الموقع"""
+        bit = self.location_bits.get(location)
+        if bit is None:
+            self.register_locations([location])
+            bit = self.location_bits[location]
+        return self.pack_bitset(self.unpack_bitset(player.get('visited_locations')) | (1 << bit))
+    
+    def visited_locations(self, player: Dict) -> set:
+        bitset = self.unpack_bitset(player.get('visited_locations'))
+        return {name for name, bit in self.location_bits.copy().items() if bitset >> bit & 1}
+    
+    def _fold_flag_rows(self, c: sqlite3.Cursor, rows: List, bitset: int, relationships: Dict):
+        """تحويل صفوف (flag_name, flag_value) القديمة إلى بتات وعلاقات"""
+        for flag_name, value in rows:
+            if flag_name.startswith("rel_"):
+                relationships[flag_name[4:]] = value
+            elif value:
+                bitset |= 1 << self._flag_bit(c, flag_name)
+        return bitset, relationships
+    
+    def _migrate_flag_rows(self, c: sqlite3.Cursor):
+        """ترحيل جدول flags القديم (صف لكل علم) إلى عمودي players ثم حذفه"""
+        c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'flags'")
+        if not c.fetchone():
+            return
+        c.execute("SELECT user_id, flag_name, flag_value FROM flags ORDER BY user_id")
+        per_user: Dict[int, List] = {}
+        for user_id, flag_name, value in c.fetchall():
+            per_user.setdefault(user_id, []).append((flag_name, value))
+        updates = []
+        for user_id, rows in per_user.items():
+            bitset, relationships = self._fold_flag_rows(c, rows, 0, {})
+            updates.append((self.pack_bitset(bitset), self.pack_map(relationships), user_id))
+        c.executemany("UPDATE players SET flags_bitset = ?, relationships = ? WHERE user_id = ?", updates)
+        c.execute("DROP TABLE flags")
+        logger.info(f"✅ تم ترحيل أعلام {len(updates)} لاعب إلى التخزين المضغوط")
+    
+    @staticmethod
+    def pack_bitset(bitset: int) -> bytes:
+        return bitset.to_bytes((bitset.bit_length() + 7) // 8, 'little')
+    
+    @staticmethod
+    def unpack_bitset(raw: Optional[bytes]) -> int:
+        return int.from_bytes(raw or b'', 'little')
+    
+    @staticmethod
+    def pack_map(values: Dict) -> str:
+        """ترميز قاموس صغير (العلاقات، السمات) كـ JSON مضغوط في عمود واحد"""
+        return json.dumps(values, ensure_ascii=False, separators=(',', ':'))
+    
+    @staticmethod
+    def unpack_map(raw: Optional[str]) -> Dict:
+        return json.loads(raw) if raw else {}
+    
+    def has_flag(self, player: Dict, flag_name: str) -> bool:
+        """فحص بت العلم على صف اللاعب المحمّل مسبقاً (بدون استعلام)"""
+        bit = self.flag_bits.get(flag_name)
+        if bit is None:
+            return False
+        return bool(self.unpack_bitset(player.get('flags_bitset')) >> bit & 1)
+    
+    def with_flag(self, player: Dict, flag_name: str) -> bytes:
+        """إرجاع قيمة flags_bitset الجديدة بعد رفع العلم، لتُكتب مع update_player"""
+        bit = self.flag_bits.get(flag_name)
+        if bit is None:
+            self.register_flags([flag_name])
+            bit = self.flag_bits[flag_name]
+        return self.pack_bitset(self.unpack_bitset(player.get('flags_bitset')) | (1 << bit))
     
     def get_player(self, user_id: int) -> Optional[Dict]:
         conn = self._get_connection()
@@ -226,65 +786,135 @@ class Database:
         conn.commit()
         conn.close()
     
-    def unlock_achievement(self, user_id: int, achievement_id: str) -> bool:
-        try:
-            conn = self._get_connection()
-            c = conn.cursor()
-            c.execute("INSERT INTO achievements (user_id, achievement_id, unlocked_at) VALUES (?, ?, ?)",
-                      (user_id, achievement_id, datetime.now().isoformat()))
-            conn.commit()
-            conn.close()
-            return True
-        except sqlite3.IntegrityError:
-            return False
-    
-    def get_achievements(self, user_id: int) -> List[Dict]:
+    def get_or_create_players(self, user_ids: List[int]) -> Dict[int, Dict]:
+        """جلب عدة لاعبين باستعلام واحد، وإنشاء غير الموجودين منهم"""
         conn = self._get_connection()
         conn.row_factory = sqlite3.Row
         c = conn.cursor()
-        c.execute("SELECT * FROM achievements WHERE user_id = ?", (user_id,))
-        rows = c.fetchall()
+        placeholders = ", ".join("?" * len(user_ids))
+        c.execute(f"SELECT * FROM players WHERE user_id IN ({placeholders})", tuple(user_ids))
+        players = {row['user_id']: dict(row) for row in c.fetchall()}
+        missing = [uid for uid in user_ids if uid not in players]
+        if missing:
+            now = datetime.now().isoformat()
+            c.executemany("INSERT OR IGNORE INTO players (user_id, last_updated) VALUES (?, ?)", [(uid, now) for uid in missing])
+            for uid in missing:
+                self._add_to_inventory(c, uid, "potion", "🧪 جرعة نقاء", 3)
+            conn.commit()
+            c.execute(f"SELECT * FROM players WHERE user_id IN ({', '.join('?' * len(missing))})", tuple(missing))
+            players.update({row['user_id']: dict(row) for row in c.fetchall()})
         conn.close()
-        return [dict(r) for r in rows]
+        return players
     
-    def set_flag(self, user_id: int, flag_name: str, value: int = 1):
+    def apply_choice_outcomes(self, outcomes: List[Dict]) -> Dict[int, List]:
+        """كتابة نتائج قرار لعدة لاعبين في معاملة واحدة (تحديثات، مخزون، إنجازات، سجل).
+        يعيد لكل لاعب قائمة (معرف الإنجاز، نتيجة الفتح) للإنجازات الجديدة"""
+        now = datetime.now().isoformat()
+        unlocked = {}
         conn = self._get_connection()
         c = conn.cursor()
-        c.execute('''INSERT INTO flags (user_id, flag_name, flag_value)
-                     VALUES (?, ?, ?)
-                     ON CONFLICT(user_id, flag_name) DO UPDATE SET flag_value = excluded.flag_value''',
-                  (user_id, flag_name, value))
-        conn.commit()
-        conn.close()
+        try:
+            for o in outcomes:
+                user_id = o["user_id"]
+                updates = {k: v for k, v in o["updates"].items() if k in self.player_columns}
+                if updates:
+                    set_clause = ", ".join(f"{k} = ?" for k in updates)
+                    c.execute(f"UPDATE players SET {set_clause}, last_updated = ? WHERE user_id = ?",
+                              (*updates.values(), now, user_id))
+                for item_id, item_name, qty in o["inventory_add"]:
+                    self._add_to_inventory(c, user_id, item_id, item_name, qty)
+                for item_id, qty in o["inventory_remove"]:
+                    self._remove_from_inventory(c, user_id, item_id, qty)
+                unlocked[user_id] = []
+                for achievement_id in o["achievements"]:
+                    result = self._unlock_achievement(c, user_id, achievement_id, now)
+                    if result:
+                        unlocked[user_id].append((achievement_id, result))
+            c.executemany("INSERT INTO history (user_id, part_id, choice_text, impact_summary, timestamp) VALUES (?, ?, ?, ?, ?)",
+                          [(o["user_id"], o["part_id"], o["choice_text"], o["impact_summary"], now) for o in outcomes])
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return unlocked
     
-    def get_flag(self, user_id: int, flag_name: str) -> int:
+    def _unlock_achievement(self, c: sqlite3.Cursor, user_id: int, achievement_id: str, now: str) -> Optional[Dict]:
+        """يفتح الإنجاز ويحدّث عداده ضمن معاملة المستدعي.
+        يعيد None إن كان مفتوحاً مسبقاً، وإلا {"unlock_count", "server_first"}"""
+        c.execute("INSERT OR IGNORE INTO achievements (user_id, achievement_id, unlocked_at) VALUES (?, ?, ?)",
+                  (user_id, achievement_id, now))
+        if c.rowcount == 0:
+            return None
+        c.execute('''INSERT INTO achievement_stats (achievement_id, unlock_count, first_user_id, first_unlocked_at)
+                     VALUES (?, 1, ?, ?)
+                     ON CONFLICT(achievement_id) DO UPDATE SET
+                     unlock_count = unlock_count + 1,
+                     first_user_id = COALESCE(first_user_id, excluded.first_user_id),
+                     first_unlocked_at = COALESCE(first_unlocked_at, excluded.first_unlocked_at)''',
+                  (achievement_id, user_id, now))
+        c.execute("SELECT unlock_count, first_user_id, first_unlocked_at FROM achievement_stats WHERE achievement_id = ?",
+                  (achievement_id,))
+        count, first_user_id, first_unlocked_at = c.fetchone()
+        return {
+            "unlock_count": count,
+            "server_first": first_user_id == user_id and first_unlocked_at == now
+        }
+    
+    def refresh_achievement_snapshot(self):
+        """تحديث النسخة المحفوظة في الذاكرة من عدادات الإنجازات وعدد اللاعبين"""
         conn = self._get_connection()
         c = conn.cursor()
-        c.execute("SELECT flag_value FROM flags WHERE user_id = ? AND flag_name = ?", (user_id, flag_name))
-        result = c.fetchone()
+        c.execute("SELECT achievement_id, unlock_count FROM achievement_stats")
+        counts = {row[0]: row[1] for row in c.fetchall()}
+        c.execute("SELECT COUNT(*) FROM players")
+        total = c.fetchone()[0]
         conn.close()
-        return result[0] if result else 0
+        self.achievement_counts = counts
+        self.total_players = total
     
-    def add_to_inventory(self, user_id: int, item_id: str, item_name: str = None, quantity: int = 1):
-        if not item_name:
-            item_name = item_id
+    def get_achievement_rarity(self, achievement_id: str) -> float:
+        """نسبة اللاعبين الذين فتحوا الإنجاز من النسخة المحفوظة (بدون استعلام)"""
+        if not self.total_players:
+            return 0.0
+        return min(100.0, self.achievement_counts.get(achievement_id, 0) / self.total_players * 100)
+    
+    def get_achievements(self, user_id: int) -> List[Dict]:
         conn = self._get_connection()
+        conn.row_factory = sqlite3.Row
         c = conn.cursor()
+        c.execute("SELECT * FROM achievements WHERE user_id = ?", (user_id,))
+        rows = c.fetchall()
+        conn.close()
+        return [dict(r) for r in rows]
+    
+    def _add_to_inventory(self, c: sqlite3.Cursor, user_id: int, item_id: str, item_name: str, quantity: int):
         c.execute('''INSERT INTO inventory (user_id, item_id, item_name, quantity)
                      VALUES (?, ?, ?, ?)
                      ON CONFLICT(user_id, item_id) DO UPDATE SET
                      quantity = quantity + excluded.quantity,
                      item_name = excluded.item_name''',
                   (user_id, item_id, item_name, quantity))
+    
+    def _remove_from_inventory(self, c: sqlite3.Cursor, user_id: int, item_id: str, quantity: int):
+        c.execute('''UPDATE inventory SET quantity = quantity - ?
+                     WHERE user_id = ? AND item_id = ?''', (quantity, user_id, item_id))
+        c.execute('''DELETE FROM inventory WHERE user_id = ? AND item_id = ? AND quantity <= 0''', (user_id, item_id))
+    
+    def add_to_inventory(self, user_id: int, item_id: str, item_name: str = None, quantity: int = 1):
+        if not item_name:
+            item_name = item_id
+        conn = self._get_connection()
+        c = conn.cursor()
+        self._add_to_inventory(c, user_id, item_id, item_name, quantity)
         conn.commit()
         conn.close()
     
     def remove_from_inventory(self, user_id: int, item_id: str, quantity: int = 1):
         conn = self._get_connection()
         c = conn.cursor()
-        c.execute('''UPDATE inventory SET quantity = quantity - ?
-                     WHERE user_id = ? AND item_id = ?''', (quantity, user_id, item_id))
-        c.execute('''DELETE FROM inventory WHERE user_id = ? AND item_id = ? AND quantity <= 0''', (user_id, item_id))
+        self._remove_from_inventory(c, user_id, item_id, quantity)
         conn.commit()
         conn.close()
     
@@ -321,6 +951,240 @@ class Database:
         rows = c.fetchall()
         conn.close()
         return [dict(r) for r in rows]
+    
+    def get_assets(self) -> List[Dict]:
+        conn = self._get_connection()
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute("SELECT * FROM assets")
+        rows = c.fetchall()
+        conn.close()
+        return [dict(r) for r in rows]
+    
+    def upsert_asset(self, name: str, file_hash: str, message_id: int, attachment_id: int, url: str, expires_at: Optional[str]):
+        conn = self._get_connection()
+        c = conn.cursor()
+        c.execute('''INSERT INTO assets (name, file_hash, message_id, attachment_id, url, expires_at, updated_at)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)
+                     ON CONFLICT(name) DO UPDATE SET
+                     file_hash = excluded.file_hash, message_id = excluded.message_id,
+                     attachment_id = excluded.attachment_id, url = excluded.url,
+                     expires_at = excluded.expires_at, updated_at = excluded.updated_at''',
+                  (name, file_hash, message_id, attachment_id, url, expires_at, datetime.now().isoformat()))
+        conn.commit()
+        conn.close()
+    
+    # ---------- ترحيل معرفات الأجزاء (Story Migrations) ----------
+    def _load_part_remap(self, c: sqlite3.Cursor, mapping: Dict[str, str]):
+        c.execute("CREATE TEMP TABLE IF NOT EXISTS part_remap (old_part TEXT PRIMARY KEY, new_part TEXT)")
+        c.execute("DELETE FROM part_remap")
+        c.executemany("INSERT INTO part_remap (old_part, new_part) VALUES (?, ?)", mapping.items())
+    
+    def _key_batches(self, c: sqlite3.Cursor, table: str, key: str, batch_size: int):
+        """نطاقات متتالية (الأدنى حصراً، الأعلى شاملاً) من المفتاح بحجم batch_size صف لكل نطاق"""
+        last = None
+        while True:
+            c.execute(f'''SELECT MAX({key}) FROM (SELECT {key} FROM {table}
+                          WHERE {key} > COALESCE(?, -9223372036854775808) ORDER BY {key} LIMIT ?)''', (last, batch_size))
+            upper = c.fetchone()[0]
+            if upper is None:
+                return
+            yield last, upper
+            last = upper
+            time.sleep(MIGRATION_BATCH_PAUSE)
+    
+    def preview_part_remap(self, mapping: Dict[str, str], batch_size: int = 5000) -> Dict[str, Dict[str, int]]:
+        """تقرير تجريبي: عدد اللاعبين وصفوف السجل التي يمسها كل تحويل.
+        يُعد على نطاقات من المفتاح (كل نطاق قراءة قصيرة) بدلاً من مسح كامل في قراءة واحدة"""
+        conn = self._get_connection()
+        c = conn.cursor()
+        self._load_part_remap(c, mapping)
+        conn.commit()
+        report = {old: {"players": 0, "history": 0} for old in mapping}
+        for table, key, column, field in (("players", "user_id", "current_part", "players"),
+                                          ("history", "id", "part_id", "history")):
+            for last, upper in self._key_batches(c, table, key, batch_size):
+                c.execute(f'''SELECT {column}, COUNT(*) FROM {table}
+                              WHERE {key} > COALESCE(?, -9223372036854775808) AND {key} <= ?
+                              AND {column} IN (SELECT old_part FROM part_remap) GROUP BY {column}''', (last, upper))
+                for old, count in c.fetchall():
+                    report[old][field] += count
+        conn.close()
+        return report
+    
+    def _remap_in_batches(self, conn: sqlite3.Connection, table: str, key: str, column: str, batch_size: int,
+                          stamp_column: Optional[str] = None) -> int:
+        """تحديث مجموعي على نطاقات متتالية من المفتاح، مع commit بعد كل دفعة لتحرير قفل الكتابة.
+        stamp_column: عمود وقت التعديل الذي يُحدّث مع الصف (مثل last_updated لتصدير التحليلات)"""
+        c = conn.cursor()
+        changed = 0
+        stamp = f", {stamp_column} = :now" if stamp_column else ""
+        for last, upper in self._key_batches(c, table, key, batch_size):
+            c.execute(f'''UPDATE {table} SET {column} = (SELECT new_part FROM part_remap WHERE old_part = {table}.{column}){stamp}
+                          WHERE {key} > COALESCE(:last, -9223372036854775808) AND {key} <= :upper
+                          AND {column} IN (SELECT old_part FROM part_remap)''',
+                      {"last": last, "upper": upper, "now": datetime.now().isoformat()})
+            changed += c.rowcount
+            conn.commit()
+        return changed
+    
+    def apply_part_remap(self, version: str, mapping: Dict[str, str], batch_size: int = 5000) -> Optional[Dict[str, int]]:
+        """إعادة كتابة current_part و history.part_id لكل اللاعبين حسب جدول التحويل.
+        صف الإصدار يُحجز أولاً، فيعيد None إن كان الإصدار مطبقاً أو قيد التطبيق من طلب آخر؛
+        ويُحذف الحجز إن فشل التطبيق حتى يمكن إعادته.
+        صفوف history المُصدَّرة سابقاً إلى ملفات التحليلات تبقى هناك بمعرفات الأجزاء القديمة"""
+        conn = self._get_connection()
+        c = conn.cursor()
+        try:
+            c.execute("INSERT INTO story_migrations (version, applied_at) VALUES (?, ?)",
+                      (version, datetime.now().isoformat()))
+            conn.commit()
+        except sqlite3.IntegrityError:
+            conn.close()
+            return None
+        try:
+            self._load_part_remap(c, mapping)
+            conn.commit()
+            players = self._remap_in_batches(conn, "players", "user_id", "current_part", batch_size, "last_updated")
+            history = self._remap_in_batches(conn, "history", "id", "part_id", batch_size)
+            c.execute("UPDATE story_migrations SET applied_at = ?, players = ?, history = ? WHERE version = ?",
+                      (datetime.now().isoformat(), players, history, version))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            c.execute("DELETE FROM story_migrations WHERE version = ? AND players IS NULL", (version,))
+            conn.commit()
+            raise
+        finally:
+            conn.close()
+        return {"players": players, "history": history}
+    
+    # ---------- خانات الحفظ (Save Slots) ----------
+    def _snapshot_state(self, c: sqlite3.Cursor, user_id: int) -> Optional[Dict]:
+        """قراءة الحالة الكاملة للاعب من كل الجداول كقاموس واحد"""
+        c.execute("SELECT * FROM players WHERE user_id = ?", (user_id,))
+        row = c.fetchone()
+        if not row:
+            return None
+        columns = [d[0] for d in c.description]
+        player = dict(zip(columns, row))
+        for column in BITSET_COLUMNS:
+            player[column] = (player.get(column) or b'').hex()
+        state = {"v": SAVE_FORMAT_VERSION, "player": player}
+        c.execute("SELECT item_id, item_name, quantity FROM inventory WHERE user_id = ?", (user_id,))
+        state["inventory"] = c.fetchall()
+        c.execute("SELECT achievement_id, unlocked_at FROM achievements WHERE user_id = ?", (user_id,))
+        state["achievements"] = c.fetchall()
+        c.execute("SELECT id, part_id, choice_text, impact_summary, timestamp FROM history WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                  (user_id, SAVE_HISTORY_LIMIT))
+        state["history"] = c.fetchall()[::-1]
+        state["history_id"] = state["history"][-1][0] if state["history"] else 0
+        return state
+    
+    def _delete_state(self, c: sqlite3.Cursor, user_id: int, history_after: Optional[int] = None):
+        """حذف بيانات اللاعب مع إنقاص عدادات إنجازاته.
+        history_after: حذف صفوف history الأحدث من هذا المعرف فقط (None = حذف السجل كله)"""
+        c.execute('''UPDATE achievement_stats SET unlock_count = MAX(0, unlock_count - 1)
+                     WHERE achievement_id IN (SELECT achievement_id FROM achievements WHERE user_id = ?)''', (user_id,))
+        for table in ("players", "achievements", "inventory"):
+            c.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+        if history_after is None:
+            c.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
+        else:
+            c.execute("DELETE FROM history WHERE user_id = ? AND id > ?", (user_id, history_after))
+    
+    def _write_state(self, c: sqlite3.Cursor, user_id: int, state: Dict):
+        """كتابة حالة محفوظة في الجداول (يفترض أن بيانات اللاعب حُذفت مسبقاً، والسجل بعد history_id)"""
+        c.execute("PRAGMA table_info(players)")
+        known = {r[1] for r in c.fetchall()}
+        player = {k: v for k, v in state["player"].items() if k in known}
+        player["user_id"] = user_id
+        # الاستعادة تغيير جديد: بدون هذا لا يلتقط تصدير التحليلات (last_updated > العلامة) اللاعب المستعاد
+        player["last_updated"] = datetime.now().isoformat()
+        if state.get("v", 1) >= 2:
+            for column in BITSET_COLUMNS:
+                if column in player:
+                    player[column] = bytes.fromhex(player[column] or '')
+        else:
+            # لقطات الإصدار 1 تحمل الأعلام كصفوف منفصلة
+            bitset, relationships = self._fold_flag_rows(c, state.get("flags", []), 0, {})
+            player["flags_bitset"] = self.pack_bitset(bitset)
+            player["relationships"] = self.pack_map(relationships)
+        c.execute(f"INSERT INTO players ({', '.join(player)}) VALUES ({', '.join('?' * len(player))})",
+                  tuple(player.values()))
+        c.executemany("INSERT INTO inventory (user_id, item_id, item_name, quantity) VALUES (?, ?, ?, ?)",
+                      [(user_id, *r) for r in state["inventory"]])
+        c.executemany("INSERT INTO achievements (user_id, achievement_id, unlocked_at) VALUES (?, ?, ?)",
+                      [(user_id, *r) for r in state["achievements"]])
+        c.executemany('''INSERT INTO achievement_stats (achievement_id, unlock_count) VALUES (?, 1)
+                         ON CONFLICT(achievement_id) DO UPDATE SET unlock_count = unlock_count + 1''',
+                      [(r[0],) for r in state["achievements"]])
+        if state.get("v", 1) >= 3:
+            # بالمعرفات الأصلية: الصفوف الباقية تُتجاهل، والمحذوفة بإعادة الضبط تعود دون معرفات جديدة
+            # (فلا يعيد تصدير التحليلات احتسابها)
+            c.executemany('''INSERT OR IGNORE INTO history (id, user_id, part_id, choice_text, impact_summary, timestamp)
+                             VALUES (?, ?, ?, ?, ?, ?)''',
+                          [(r[0], user_id, *r[1:]) for r in state["history"]])
+    
+    def _store_snapshot(self, c: sqlite3.Cursor, user_id: int, slot: int, state: Dict):
+        blob = zlib.compress(json.dumps(state, ensure_ascii=False).encode('utf-8'))
+        c.execute('''INSERT INTO save_slots (user_id, slot, part_id, saved_at, data) VALUES (?, ?, ?, ?, ?)
+                     ON CONFLICT(user_id, slot) DO UPDATE SET
+                     part_id = excluded.part_id, saved_at = excluded.saved_at, data = excluded.data''',
+                  (user_id, slot, state["player"].get("current_part"), datetime.now().isoformat(), blob))
+    
+    def save_slot(self, user_id: int, slot: int) -> bool:
+        """حفظ الحالة الكاملة للاعب في خانة كـ blob مضغوط واحد"""
+        conn = self._get_connection()
+        c = conn.cursor()
+        state = self._snapshot_state(c, user_id)
+        if state:
+            self._store_snapshot(c, user_id, slot, state)
+            conn.commit()
+        conn.close()
+        return state is not None
+    
+    def load_slot(self, user_id: int, slot: int) -> bool:
+        """استعادة حالة محفوظة بالكامل داخل معاملة واحدة"""
+        conn = self._get_connection()
+        c = conn.cursor()
+        c.execute("SELECT data FROM save_slots WHERE user_id = ? AND slot = ?", (user_id, slot))
+        row = c.fetchone()
+        if not row:
+            conn.close()
+            return False
+        state = json.loads(zlib.decompress(row[0]).decode('utf-8'))
+        try:
+            # اللقطات القديمة (قبل الإصدار 3) لا تعرف معرفات السجل، فيبقى السجل كما هو
+            self._delete_state(c, user_id, state.get("history_id", sys.maxsize))
+            self._write_state(c, user_id, state)
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return True
+    
+    def get_save_slots(self, user_id: int) -> List[Dict]:
+        conn = self._get_connection()
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute("SELECT slot, part_id, saved_at FROM save_slots WHERE user_id = ? ORDER BY slot", (user_id,))
+        rows = c.fetchall()
+        conn.close()
+        return [dict(r) for r in rows]
+    
+    def reset_player(self, user_id: int):
+        """حفظ نسخة تلقائية في الخانة 0 ثم حذف كل بيانات اللاعب في نفس المعاملة"""
+        conn = self._get_connection()
+        c = conn.cursor()
+        state = self._snapshot_state(c, user_id)
+        if state:
+            self._store_snapshot(c, user_id, AUTOSAVE_SLOT, state)
+        self._delete_state(c, user_id)
+        conn.commit()
+        conn.close()
 
 # ============================================
 # واجهات مساعدة (UI Helpers)
@@ -340,42 +1204,415 @@ class GameUI:
     @staticmethod
     def get_alignment_emoji(alignment: str) -> str:
         return {"Light": "✨", "Gray": "⚪", "Dark": "🌑"}.get(alignment, "⚪")
+    
+    @staticmethod
+    def choice_button_style(choice: Dict) -> discord.ButtonStyle:
+        if "⚔️" in choice.get("emoji", "") or "قتال" in choice.get("text", ""):
+            return discord.ButtonStyle.danger
+        elif "هرب" in choice.get("text", ""):
+            return discord.ButtonStyle.secondary
+        return discord.ButtonStyle.primary
+
+# ============================================
+# محرك القرارات (Choice Engine)
+# ============================================
+TRAIT_NAMES = {
+    "leader": "قائد", "wise": "حكيم", "honorable": "شريف", "strategic": "استراتيجي",
+    "decisive": "حاسم", "brave": "شجاع", "curious": "فضولي", "loyal": "وفي",
+    "pragmatic": "عملي", "careful": "حذر", "just": "عادل", "ruthless": "قاسٍ", "cunning": "ماكر",
+}
+
+class ChoiceEngine:
+    """يحسب نتيجة القرار كبيانات فقط، لتُكتب لاحقاً دفعة واحدة عبر Database.apply_choice_outcomes"""
+    
+    def __init__(self, story_loader: StoryLoader, db: Database):
+        self.story_loader = story_loader
+        self.db = db
+    
+    def check_requirements(self, player: Dict, choice: Dict) -> Optional[str]:
+        """يعيد رسالة الخطأ إن لم يستوفِ اللاعب شروط الخيار، وإلا None"""
+        for var, min_val in choice.get("require", {}).items():
+            if var == "flag":
+                if not self.db.has_flag(player, min_val):
+                    return "⚠️ لا يمكنك اختيار هذا المسار بعد."
+            elif var == "trait":
+                traits = Database.unpack_map(player.get('traits'))
+                for trait, threshold in min_val.items():
+                    if traits.get(trait, 0) < threshold:
+                        return f"⚠️ **سمة غير كافية!** تحتاج إلى `{threshold}` من سمة **{TRAIT_NAMES.get(trait, trait)}** لاختيار هذا المسار."
+            elif player.get(var, 0) < min_val:
+                return f"⚠️ **متطلب ناقص!** تحتاج إلى `{min_val}` من نقاط `{var}` لاختيار هذا المسار."
+        return None
+    
+    def roll(self, choice: Dict):
+        """نظام الاحتمالات: يعيد (نجاح، الجزء التالي، التأثيرات)"""
+        success = random.randint(1, 100) <= choice.get("chance", 100)
+        next_id = choice.get("next") if success else choice.get("fail_next", choice.get("next"))
+        effects = choice.get("effects" if success else "fail_effects", {})
+        return success, next_id, effects
+    
+    def build_outcome(self, player: Dict, part_id: str, choice: Dict, effects: Dict, next_id: str) -> Dict:
+        user_id = player['user_id']
+        updates = {"current_part": next_id}
+        next_location = (self.story_loader.get_part(next_id) or {}).get("location")
+        if next_location:
+            updates["location"] = next_location
+            updates["visited_locations"] = self.db.with_location(player, next_location)
+        impact_log = []
+        relationships = None
+        traits = None
+        outcome = {
+            "user_id": user_id,
+            "part_id": part_id,
+            "choice_text": choice.get('text', ''),
+            "updates": updates,
+            "achievements": [],
+            "inventory_add": [],
+            "inventory_remove": [],
+        }
+        
+        for var, val in effects.items():
+            if var == "achievement":
+                outcome["achievements"].append(val)
+                continue
+            
+            if var == "inventory_add":
+                if isinstance(val, dict):
+                    item_id = val.get("id", "unknown")
+                    item_name = val.get("name", item_id)
+                    qty = val.get("qty", 1)
+                    outcome["inventory_add"].append((item_id, item_name, qty))
+                    impact_log.append(f"حصلت على {item_name} x{qty}")
+                else:
+                    outcome["inventory_add"].append((val, val, 1))
+                    impact_log.append(f"حصلت على {val}")
+                continue
+            
+            if var == "inventory_remove":
+                if isinstance(val, dict):
+                    item_id = val.get("id")
+                    qty = val.get("qty", 1)
+                    outcome["inventory_remove"].append((item_id, qty))
+                    impact_log.append(f"فقدت {item_id} x{qty}")
+                else:
+                    outcome["inventory_remove"].append((val, 1))
+                    impact_log.append(f"فقدت {val}")
+                continue
+            
+            if var == "flag":
+                updates["flags_bitset"] = self.db.with_flag({**player, **updates}, val)
+                impact_log.append(f"علم: {val}")
+                continue
+            
+            if var == "relationship":
+                if ':' in val:
+                    char, change = val.split(':', 1)
+                    try:
+                        change = int(change)
+                        if relationships is None:
+                            relationships = Database.unpack_map(player.get('relationships'))
+                        relationships[char] = change  # تُخزن القيمة كما هي (نفس سلوك علم rel_ السابق)
+                        updates["relationships"] = Database.pack_map(relationships)
+                        impact_log.append(f"علاقة {char}: {change:+}")
+                    except:
+                        pass
+                continue
+            
+            # تأثيرات بأسماء سمات (في ملفات retro) تذهب إلى ملف الشخصية لا إلى أعمدة players
+            if var in TRAIT_NAMES:
+                if traits is None:
+                    traits = Database.unpack_map(player.get('traits'))
+                traits[var] = traits.get(var, 0) + val
+                impact_log.append(f"{TRAIT_NAMES[var]}: {val:+}")
+                continue
+            
+            # متغيرات نصية
+            if var in ["alignment", "dragon_alliance", "rival_status"]:
+                updates[var] = val
+                impact_log.append(f"{var} = {val}")
+            else:
+                # متغيرات رقمية
+                current = player.get(var, 0)
+                new_val = current + val
+                # حدود خاصة
+                if var == "corruption":
+                    new_val = GameUI.clamp(new_val, 0, 100)
+                elif var == "mystery":
+                    new_val = GameUI.clamp(new_val, 0, 100)
+                elif var == "world_stability":
+                    new_val = GameUI.clamp(new_val, 0, 100)
+                elif var == "reputation":
+                    new_val = GameUI.clamp(new_val, -50, 50)
+                elif var == "trust_aren":
+                    new_val = GameUI.clamp(new_val, 0, 100)
+                elif var == "knowledge_path":
+                    new_val = GameUI.clamp(new_val, 0, 100)
+                elif var == "shards":
+                    new_val = max(0, new_val)
+                else:
+                    new_val = max(0, new_val)
+                updates[var] = new_val
+                impact_log.append(f"{var}: {val:+}")
+        
+        # ملف الشخصية: يُحدَّث تراكمياً مع كل قرار بدلاً من إعادة حسابه من السجل
+        trait_weights = choice.get("trait_weights")
+        if trait_weights:
+            if traits is None:
+                traits = Database.unpack_map(player.get('traits'))
+            for trait, weight in trait_weights.items():
+                traits[trait] = traits.get(trait, 0) + weight
+        if traits is not None:
+            updates["traits"] = Database.pack_map(traits)
+        
+        xp_gain = random.randint(10, 20)
+        updates["xp"] = player.get("xp", 0) + xp_gain
+        impact_log.append(f"XP: +{xp_gain}")
+        
+        if updates["xp"] >= 100:
+            updates["xp"] = updates["xp"] - 100
+            updates["level"] = player.get("level", 1) + 1
+            impact_log.append(f"⬆️ مستوى {updates['level']}!")
+        
+        outcome["impact_summary"] = ", ".join(impact_log) if impact_log else "لا تأثير"
+        return outcome
+
+# ============================================
+# ذاكرة الصور (Asset Cache)
+# ============================================
+ASSET_DIR = os.getenv("ASSET_DIR", "assets")
+ASSET_CHANNEL_ID = os.getenv("ASSET_CHANNEL_ID")  # قناة تخزين تُرفع إليها الصور مرة واحدة
+ASSET_REFRESH_MARGIN = timedelta(hours=6)  # تجديد الرابط قبل انتهائه بهذه المدة
+
+class AssetCache:
+    """يربط أسماء الصور المنطقية بملفات محلية، ويخزن روابط رفعها على ديسكورد ويجددها قبل انتهائها"""
+    
+    def __init__(self, db: Database, asset_dir: str = ASSET_DIR):
+        self.db = db
+        self.asset_dir = asset_dir
+        self.files: Dict[str, str] = {}
+        self.dividers: Dict[str, List[str]] = {}
+        self.load_manifest()
+        self.urls = {row['name']: row['url'] for row in self.db.get_assets()}
+    
+    def load_manifest(self):
+        path = os.path.join(self.asset_dir, "manifest.json")
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ تعذر قراءة ملف الصور {path}: {e}")
+            return
+        for category, files in manifest.get("dividers", {}).items():
+            names = []
+            for i, rel_path in enumerate(files):
+                name = f"divider:{category}:{i}"
+                self.files[name] = os.path.join(self.asset_dir, rel_path)
+                names.append(name)
+            self.dividers[category] = names
+        for part_id, rel_path in manifest.get("parts", {}).items():
+            self.files[f"part:{part_id}"] = os.path.join(self.asset_dir, rel_path)
+    
+    def url(self, name: str) -> Optional[str]:
+        return self.urls.get(name)
+    
+    def divider_url(self, category: str) -> Optional[str]:
+        urls = [self.urls[n] for n in self.dividers.get(category, []) if n in self.urls]
+        if not urls and category != "general":
+            return self.divider_url("general")
+        return random.choice(urls) if urls else None
+    
+    @staticmethod
+    def _file_hash(path: str) -> str:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    
+    @staticmethod
+    def _url_expiry(url: str) -> Optional[str]:
+        """روابط CDN الموقعة تحمل وقت الانتهاء في المعامل ex بصيغة hex"""
+        ex = parse_qs(urlparse(url).query).get("ex")
+        if not ex:
+            return None
+        return datetime.fromtimestamp(int(ex[0], 16)).isoformat()
+    
+    async def sync(self, channel: discord.abc.Messageable):
+        cached = {row['name']: row for row in self.db.get_assets()}
+        refresh_before = (datetime.now() + ASSET_REFRESH_MARGIN).isoformat()
+        
+        for name, path in self.files.items():
+            if not os.path.exists(path):
+                continue
+            file_hash = await asyncio.to_thread(self._file_hash, path)
+            row = cached.get(name)
+            attachment = None
+            
+            if row and row['file_hash'] == file_hash:
+                if row['expires_at'] and row['expires_at'] > refresh_before:
+                    continue
+                # نفس الملف: جلب الرسالة يعطي رابطاً موقعاً جديداً بدون إعادة رفع
+                try:
+                    message = await channel.fetch_message(row['message_id'])
+                    attachment = message.attachments[0]
+                except (discord.NotFound, IndexError):
+                    attachment = None
+            
+            if attachment is None:
+                message = await channel.send(file=discord.File(path))
+                attachment = message.attachments[0]
+                logger.info(f"📤 تم رفع الصورة {name}")
+            
+            self.db.upsert_asset(name, file_hash, message.id, attachment.id, attachment.url, self._url_expiry(attachment.url))
+            self.urls[name] = attachment.url
+
+# ============================================
+# التحكم في القبول (Admission Control)
+# ============================================
+# (المعدل بالرموز في الثانية، السعة القصوى) لكل أمر؛ يمكن تعديلها عبر ADMISSION_LIMITS كـ JSON
+ADMISSION_DEFAULT_LIMIT = (0.5, 4)
+ADMISSION_LIMITS = {
+    "click": (2.0, 6),
+    "vote": (2.0, 6),
+    "ابدأ": (0.2, 3),
+    "إعادة": (0.1, 2),
+    "يومي": (0.1, 2),
+    "جماعي": (0.05, 2),
+    "حفظ": (0.2, 3),
+    "تحميل": (0.2, 3),
+}
+try:
+    ADMISSION_LIMITS.update({k: (float(v[0]), int(v[1])) for k, v in json.loads(os.getenv("ADMISSION_LIMITS", "{}")).items()})
+except (ValueError, TypeError, KeyError, IndexError, AttributeError) as e:
+    logger.warning(f"⚠️ ADMISSION_LIMITS غير صالح، سيتم استخدام الحدود الافتراضية: {e}")
+# أوامر لا تلمس قاعدة البيانات فلا تحجز مكاناً من الحد العام (تحليل_الأداء قد يستمر دقيقتين)
+ADMISSION_NO_DB = {"مساعدة", "تحليل_الأداء", "إحصائيات_القبول"}
+ADMISSION_MAX_DB_INFLIGHT = int(os.getenv("ADMISSION_MAX_DB_INFLIGHT", "32"))  # حد عام للعمليات الجارية على قاعدة البيانات
+ADMISSION_MAX_BUCKETS = 50000
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+    
+    def __init__(self, rate: float, capacity: int, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = now
+    
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def take(self, now: float) -> bool:
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+class AdmissionControl:
+    """دلو رموز لكل (مستخدم، أمر) في الذاكرة، وحد عام للعمليات المتزامنة على قاعدة البيانات.
+    الطلب المرفوض يأخذ رداً مؤقتاً رخيصاً دون أي عمل على قاعدة البيانات"""
+    
+    def __init__(self, limits: Dict[str, tuple] = ADMISSION_LIMITS, default: tuple = ADMISSION_DEFAULT_LIMIT,
+                 max_db_inflight: int = ADMISSION_MAX_DB_INFLIGHT):
+        self.limits = limits
+        self.default = default
+        self.max_db_inflight = max_db_inflight
+        # LRU: الأحدث استخداماً في النهاية، ويُطرد الأقدم عند تجاوز ADMISSION_MAX_BUCKETS
+        self.buckets: "OrderedDict[tuple, TokenBucket]" = OrderedDict()
+        self.db_inflight = 0
+        self.admitted = Counter()
+        self.rejected = Counter()
+        # stats() تُستدعى من خيط Flask بينما الحلقة تعدل العدادات
+        self._lock = threading.Lock()
+    
+    def try_admit(self, user_id: int, key: str, db: bool = True) -> Optional[str]:
+        """يعيد None عند القبول، أو سبب الرفض: "rate" أو "busy" """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self.buckets.get((user_id, key))
+            if bucket is None:
+                while len(self.buckets) >= ADMISSION_MAX_BUCKETS:
+                    self.buckets.popitem(last=False)  # O(1): أقدم دلو لم يُستخدم منذ أطول مدة
+                rate, capacity = self.limits.get(key, self.default)
+                bucket = self.buckets[(user_id, key)] = TokenBucket(rate, capacity, now)
+            else:
+                self.buckets.move_to_end((user_id, key))
+            if not bucket.take(now):
+                self.rejected[(key, "rate")] += 1
+                return "rate"
+            if db and self.db_inflight >= self.max_db_inflight:
+                bucket.tokens += 1  # لا نعاقب المستخدم على ازدحام عام
+                self.rejected[(key, "busy")] += 1
+                return "busy"
+            if db:
+                self.db_inflight += 1
+            self.admitted[key] += 1
+            return None
+    
+    async def admit(self, interaction: discord.Interaction, key: str, db: bool = True) -> bool:
+        reason = self.try_admit(interaction.user.id, key, db)
+        if reason is None:
+            if db:
+                interaction.extras["admission_slot"] = True
+            return True
+        message = "🐢 تمهل قليلاً! أنت ترسل الأوامر بسرعة كبيرة." if reason == "rate" else "⏳ البوت مشغول الآن، حاول بعد لحظات."
+        try:
+            await interaction.response.send_message(message, ephemeral=True)
+        except discord.HTTPException:
+            pass
+        return False
+    
+    def release(self, interaction: discord.Interaction):
+        if interaction.extras.pop("admission_slot", False):
+            with self._lock:
+                self.db_inflight -= 1
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            keys = sorted(set(self.admitted) | {k for k, _ in self.rejected})
+            return {
+                "db_inflight": self.db_inflight,
+                "buckets": len(self.buckets),
+                "commands": {
+                    key: {
+                        "admitted": self.admitted[key],
+                        "rejected_rate": self.rejected[(key, "rate")],
+                        "rejected_busy": self.rejected[(key, "busy")],
+                    }
+                    for key in keys
+                },
+            }
+
+admission = AdmissionControl()
+
+class AdmissionTree(app_commands.CommandTree):
+    """شجرة أوامر تمر كل أوامر السلاش فيها عبر التحكم في القبول قبل التنفيذ"""
+    
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        key = interaction.command.name if interaction.command else "command"
+        return await admission.admit(interaction, key, db=key not in ADMISSION_NO_DB)
+    
+    async def _call(self, interaction: discord.Interaction):
+        try:
+            await super()._call(interaction)
+        finally:
+            admission.release(interaction)
 
 # ============================================
 # البوت الرئيسي مع الفواصل
 # ============================================
 class ShardBot(commands.Bot):
     def __init__(self):
-        super().__init__(command_prefix="!", intents=intents)
+        super().__init__(command_prefix="!", intents=intents, tree_cls=AdmissionTree)
         self.story_loader = StoryLoader()
         self.db = Database()
+        self.db.register_flags(self.story_loader.flag_names)
+        self.db.register_locations(self.story_loader.locations)
+        self.engine = ChoiceEngine(self.story_loader, self.db)
         
-        # فواصل الصور (Dividers) حسب النوع
-        self.divider_images = {
-            "combat": [
-                "https://media.discordapp.net/attachments/1475249056036032555/1475949842902683710/IMG_7045.png?ex=699f58e8&is=699e0768&hm=815d85803ff82737a7db1eb8cc4046c609038ee3d6bb6c520a83b323661196ee&=&format=webp&quality=lossless&width=600&height=90"
-            ],
-            "city": [
-                "https://media.discordapp.net/attachments/1475249056036032555/1475949756751679488/IMG_9090.png?ex=699f58d3&is=699e0753&hm=715e9b08ccceda4c2db76f2b6f698ec94487482ee2caa44ca4ed7c18b59edcbe&=&format=webp&quality=lossless&width=315&height=48"
-            ],
-            "nature": [
-                "https://media.discordapp.net/attachments/1475249056036032555/1475949815392243762/IMG_9160.gif?ex=699f58e1&is=699e0761&hm=e8ed0637453557bdb5ba5a051197e7fe4b5a3c9e0233eb797e94bfe08a7888a6&=&width=260&height=96"
-            ],
-            "dark": [
-                "https://media.discordapp.net/attachments/1475249056036032555/1475949841241866302/IMG_9464.gif?ex=699f58e7&is=699e0767&hm=23c42d53be60e6efb6a9fc8c8188798237b431157a6f116995d864a29f2e7d46&=&width=600&height=168"
-            ],
-            "shard": [
-                "https://media.discordapp.net/attachments/1475249056036032555/1475949754281234564/IMG_8722.gif?ex=699f58d3&is=699e0753&hm=e4ec64a8dd5dad334f8ebda6c756c1fb822d79b2d9829567fd1f93c2a861caaf&=&width=902&height=32"
-            ],
-            "ending": [
-                "https://media.discordapp.net/attachments/1475249056036032555/1475949741681541204/t3oosp.png?ex=699f58d0&is=699e0750&hm=bc244db5574d6188a1d50c707f2b02edf9b3cc4653ddf92f4b654cc23b2b7a86&=&format=webp&quality=lossless&width=1500&height=627"
-            ],
-            "general": [
-                "https://media.discordapp.net/attachments/1472302270770053120/1472303048943468695/IMG_3554.gif?ex=699f4390&is=699df210&hm=f8f917593e7434a346a8f09afa943fedbafbda9fd7c979334a3b09fc53ac4a3a&=&width=675&height=36"
-            ]
-        }
+        # الصور (الفواصل وصور الأجزاء) تُرفع مرة واحدة وتُخزن روابطها في قاعدة البيانات
+        self.assets = AssetCache(self.db)
     
-    def get_divider_for_part(self, part: Dict) -> str:
+    def get_divider_for_part(self, part: Dict) -> Optional[str]:
         """تحديد فاصل مناسب بناءً على محتوى الجزء"""
         text = (part.get('title', '') + ' ' + part.get('text', '')).lower()
         location = part.get('location', '').lower()
@@ -383,39 +1620,114 @@ class ShardBot(commands.Bot):
         # كلمات مفتاحية للمعارك
         combat_keywords = ['قتال', 'معركة', 'ضربة', 'سيف', 'يضرب', 'يهاجم', 'يدافع', 'حرب', 'سلاح', 'مقاتل']
         if any(word in text for word in combat_keywords):
-            return random.choice(self.divider_images["combat"])
+            return self.assets.divider_url("combat")
         
         # كلمات مفتاحية للمدن
         city_keywords = ['مدينة', 'قرية', 'قصر', 'سوق', 'مملكة', 'إيلثار', 'بوابة', 'قلعة', 'بيت', 'شارع']
         if any(word in text for word in city_keywords):
-            return random.choice(self.divider_images["city"])
+            return self.assets.divider_url("city")
         
         # كلمات مفتاحية للطبيعة
         nature_keywords = ['غابة', 'نهر', 'جبل', 'شجرة', 'وادي', 'صحراء', 'بحر', 'سماء', 'أرض', 'عشب']
         if any(word in text for word in nature_keywords):
-            return random.choice(self.divider_images["nature"])
+            return self.assets.divider_url("nature")
         
         # كلمات مفتاحية للظلام والغموض
         dark_keywords = ['ظل', 'ظلام', 'غموض', 'خوف', 'مخيف', 'كابوس', 'ليل', 'مظلم', 'رهبة', 'وحش']
         if any(word in text for word in dark_keywords):
-            return random.choice(self.divider_images["dark"])
+            return self.assets.divider_url("dark")
         
         # كلمات مفتاحية للشظايا
         shard_keywords = ['شظية', 'شظايا', 'طاقة', 'كريستال', 'نور', 'ضوء', 'قوة', 'شعاع']
         if any(word in text for word in shard_keywords):
-            return random.choice(self.divider_images["shard"])
+            return self.assets.divider_url("shard")
         
         # كلمات مفتاحية للنهايات
         ending_keywords = ['نهاية', 'ختام', 'انتهى', 'وداع', 'أخير', 'خاتمة']
         if any(word in text for word in ending_keywords):
-            return random.choice(self.divider_images["ending"])
+            return self.assets.divider_url("ending")
         
         # إذا لم يجد، يستخدم العام
-        return random.choice(self.divider_images["general"])
+        return self.assets.divider_url("general")
+    
+    def _command_payload_hash(self) -> str:
+        """بصمة SHA-256 لحمولة أوامر السلاش كما سترسل إلى ديسكورد"""
+        payload = sorted(
+            (cmd.to_dict(self.tree) for cmd in self.tree.get_commands()),
+            key=lambda c: (c.get('type', 1), c['name'])
+        )
+        raw = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+    
+    def _load_sync_state(self) -> Dict:
+        try:
+            with open(COMMAND_SYNC_STATE_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    def _save_sync_state(self, state: Dict):
+        try:
+            with open(COMMAND_SYNC_STATE_FILE, 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+        except OSError as e:
+            logger.warning(f"⚠️ تعذر حفظ بصمة الأوامر: {e}")
+    
+    async def sync_commands(self, force: bool = False):
+        """مزامنة الأوامر فقط إذا تغيرت بصمتها منذ آخر مزامنة ناجحة"""
+        guild = discord.Object(id=int(DEV_GUILD_ID)) if DEV_GUILD_ID else None
+        if guild:
+            # وضع التطوير: مزامنة فورية على سيرفر واحد بدلاً من المزامنة العامة البطيئة
+            self.tree.copy_global_to(guild=guild)
+        # البصمة مرتبطة بالتطبيق أيضاً: تغيير TOKEN إلى بوت آخر يجب أن يعيد المزامنة
+        scope = f"{self.application_id}:" + (f"guild:{guild.id}" if guild else "global")
+        
+        digest = self._command_payload_hash()
+        state = self._load_sync_state()
+        if not force and state.get(scope) == digest:
+            logger.info(f"⏭️ الأوامر لم تتغير ({scope})، تم تخطي المزامنة")
+            return
+        
+        try:
+            await self.tree.sync(guild=guild)
+        except discord.HTTPException as e:
+            logger.error(f"❌ فشلت مزامنة الأوامر ({scope}): {e}")
+            return
+        state[scope] = digest
+        self._save_sync_state(state)
+        logger.info(f"✅ تم مزامنة الأوامر ({scope})")
     
     async def setup_hook(self):
-        await self.tree.sync()
-        logger.info("✅ تم مزامنة الأوامر")
+        stall_detector.start()
+        profiler.target_thread = stall_detector.loop_thread
+        # منفذ مسمى حتى يجد المحلل خيوط asyncio.to_thread ويعاينها
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(thread_name_prefix=WORKER_THREAD_PREFIX))
+        await self.sync_commands(force=FORCE_COMMAND_SYNC)
+        self.refresh_achievement_stats.start()
+        self.refresh_assets.start()
+    
+    @tasks.loop(hours=1)
+    async def refresh_assets(self):
+        """رفع الصور الجديدة وتجديد الروابط التي تقترب من انتهاء صلاحيتها"""
+        if not ASSET_CHANNEL_ID:
+            return
+        try:
+            channel = self.get_channel(int(ASSET_CHANNEL_ID)) or await self.fetch_channel(int(ASSET_CHANNEL_ID))
+            await self.assets.sync(channel)
+        except Exception as e:
+            logger.error(f"خطأ في تحديث الصور: {e}", exc_info=True)
+    
+    @refresh_assets.before_loop
+    async def before_refresh_assets(self):
+        await self.wait_until_ready()
+    
+    @tasks.loop(minutes=5)
+    async def refresh_achievement_stats(self):
+        """تحديث دوري لإحصائيات ندرة الإنجازات"""
+        try:
+            self.db.refresh_achievement_snapshot()
+        except Exception as e:
+            logger.error(f"خطأ في تحديث إحصائيات الإنجازات: {e}")
     
     def create_game_embed(self, part: Dict, p: Dict) -> discord.Embed:
         alignment_color = {
@@ -433,7 +1745,11 @@ class ShardBot(commands.Bot):
         
         # اختيار فاصل مناسب ووضعه كصورة
         divider_url = self.get_divider_for_part(part)
-        embed.set_image(url=divider_url)
+        if divider_url:
+            embed.set_image(url=divider_url)
+        part_image = self.assets.url(f"part:{part['id']}")
+        if part_image:
+            embed.set_thumbnail(url=part_image)
         
         # إحصائيات
         stats = (
@@ -450,12 +1766,44 @@ class ShardBot(commands.Bot):
         embed.add_field(name="🛡️ حالة المغامر", value=stats, inline=False)
         embed.set_footer(text=f"معرف الجزء: {part['id']} • رحلة الشظايا")
         return embed
+    
+    def create_party_embed(self, part: Dict, votes: Dict[int, int], members: int) -> discord.Embed:
+        embed = discord.Embed(
+            title=f"👥 {part.get('title', 'فصل جديد')}",
+            description=part.get('text', '')[:4000],
+            color=discord.Color.teal(),
+            timestamp=datetime.now()
+        )
+        divider_url = self.get_divider_for_part(part)
+        if divider_url:
+            embed.set_image(url=divider_url)
+        
+        tally = Counter(votes.values())
+        lines = [
+            f"{choice.get('text', f'خيار {i+1}')[:60]} — **{tally.get(i, 0)}**"
+            for i, choice in enumerate(part.get("choices", []))
+        ]
+        if lines:
+            embed.add_field(name=f"🗳️ الأصوات ({len(votes)})", value="\n".join(lines), inline=False)
+        embed.set_footer(text=f"معرف الجزء: {part['id']} • 👥 {members} مغامر • رحلة جماعية")
+        return embed
 
 bot = ShardBot()
 
 # ============================================
 # عرض القصة مع الأزرار (محدث)
 # ============================================
+# "fast": الرد بـ edit_message مباشرة إن انتهى العمل ضمن الميزانية، "defer": التأجيل ثم تعديل الرسالة دائماً
+CLICK_RESPONSE_MODE = os.getenv("CLICK_RESPONSE_MODE", "fast")
+CLICK_FAST_BUDGET_MS = float(os.getenv("CLICK_FAST_BUDGET_MS", "1500"))  # مهلة Discord للرد الأول 3 ثوانٍ
+CLICK_FAST_BUDGET_MAX_MS = 2500  # هامش لزمن الشبكة قبل انتهاء نافذة الثلاث ثوانٍ
+if not CLICK_FAST_BUDGET_MS <= CLICK_FAST_BUDGET_MAX_MS:
+    logger.warning(f"⚠️ CLICK_FAST_BUDGET_MS={CLICK_FAST_BUDGET_MS} يتجاوز مهلة Discord، سيتم استخدام {CLICK_FAST_BUDGET_MAX_MS}")
+    CLICK_FAST_BUDGET_MS = CLICK_FAST_BUDGET_MAX_MS
+
+# قفل لكل لاعب تشترك فيه النقرات الفردية وجولات المجموعة؛ يُحذف تلقائياً حين لا يحتفظ به أحد
+_click_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
 class StoryView(discord.ui.View):
     def __init__(self, bot, user_id: int, part_data: Dict):
         super().__init__(timeout=None)
@@ -466,179 +1814,412 @@ class StoryView(discord.ui.View):
     
     def _setup_buttons(self):
         for i, choice in enumerate(self.part_data.get("choices", [])):
-            style = discord.ButtonStyle.primary
-            if "⚔️" in choice.get("emoji", "") or "قتال" in choice.get("text", ""):
-                style = discord.ButtonStyle.danger
-            elif "هرب" in choice.get("text", ""):
-                style = discord.ButtonStyle.secondary
-            
             custom_id = f"c_{self.part_data['id']}_{i}_{self.user_id}"
             
             btn = discord.ui.Button(
                 label=choice.get("text", f"خيار {i+1}")[:80],
                 custom_id=custom_id,
                 emoji=choice.get("emoji"),
-                style=style
+                style=GameUI.choice_button_style(choice)
             )
             btn.callback = self._create_callback(choice)
             self.add_item(btn)
     
+    def _resolve_choice(self, choice: Dict) -> Dict:
+        """كل عمل قاعدة البيانات للنقرة (يعمل في خيط منفصل): يعيد {"error": ...} أو نتيجة الخيار"""
+        player = self.bot.db.get_player(self.user_id)
+        if not player:
+            self.bot.db.create_player(self.user_id)
+            player = self.bot.db.get_player(self.user_id)
+        
+        # زر من رسالة قديمة (أو نقرة ثانية بعد أن تقدم اللاعب) لا يُطبق مرة أخرى
+        if player.get('current_part') != self.part_data['id']:
+            return {"error": "⚠️ هذا الجزء لم يعد جزءك الحالي. استخدم /استمر لعرض موقعك الآن.", "result": "stale"}
+        
+        # فحص الشروط
+        error = self.bot.engine.check_requirements(player, choice)
+        if error:
+            return {"error": error, "result": "requirement"}
+        
+        success, next_id, effects = self.bot.engine.roll(choice)
+        
+        # التحقق من وجود الجزء التالي قبل تحديث قاعدة البيانات
+        next_part = self.bot.story_loader.get_part(next_id)
+        if next_id is None or next_part is None:
+            logger.error("Missing next part referenced: %s from %s", next_id, self.part_data.get('id'))
+            return {"error": f"⚠️ خطأ في القصة: الجزء `{next_id}` غير معرف. سيتم إبلاغ المطور.", "result": "missing_part"}
+        
+        outcome = self.bot.engine.build_outcome(player, self.part_data['id'], choice, effects, next_id)
+        unlocked = self.bot.db.apply_choice_outcomes([outcome])[self.user_id]
+        
+        # حالة اللاعب بعد التغييرات (بدون إعادة قراءة)
+        updated_player = {**player, **outcome["updates"]}
+        return {
+            "success": success,
+            "next_part": next_part,
+            "embed": self.bot.create_game_embed(next_part, updated_player),
+            "unlocked": unlocked,
+        }
+    
+    def _log_click(self, choice: Dict, result: str, started: float, **fields):
+        """سجل مهيكل لكل نقرة أياً كانت نتيجتها (ok, not_owner, busy, rejected, stale, requirement, missing_part, error)"""
+        if click_logger.isEnabledFor(logging.INFO):
+            click_logger.info("choice", extra={
+                "user": self.user_id,
+                "part": self.part_data['id'],
+                "choice": choice.get('text', ''),
+                "result": result,
+                "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+                **fields,
+            })
+    
     def _create_callback(self, choice):
         async def callback(interaction: discord.Interaction):
-            logger.info(f"User {interaction.user.id} clicked button: {choice.get('text')}")
+            started = time.perf_counter()
             
             if interaction.user.id != self.user_id:
                 await interaction.response.send_message("❌ هذه القصة ليست لك!", ephemeral=True)
+                self._log_click(choice, "not_owner", started)
                 return
             
-            await interaction.response.defer()
+            # نقرة واحدة لكل لاعب في وقت واحد: قراءة-تعديل-كتابة صفه لا تتداخل
+            lock = _click_locks.setdefault(self.user_id, asyncio.Lock())
+            if lock.locked():
+                await interaction.response.send_message("⏳ قرارك السابق ما زال قيد التنفيذ.", ephemeral=True)
+                self._log_click(choice, "busy", started)
+                return
+            
+            if not await admission.admit(interaction, "click"):
+                self._log_click(choice, "rejected", started)
+                return
             
+            await lock.acquire()
             try:
-                player = self.bot.db.get_player(self.user_id)
-                if not player:
-                    self.bot.db.create_player(self.user_id)
-                    player = self.bot.db.get_player(self.user_id)
+                # الوضع السريع: الرد بتعديل الرسالة عبر رمز التفاعل نفسه (رحلة واحدة)،
+                # ولا نؤجل إلا إذا تجاوز عمل قاعدة البيانات الميزانية
+                work = asyncio.ensure_future(asyncio.to_thread(self._resolve_choice, choice))
+                deferred = CLICK_RESPONSE_MODE != "fast"
+                if not deferred:
+                    done, _ = await asyncio.wait({work}, timeout=CLICK_FAST_BUDGET_MS / 1000)
+                    deferred = not done
+                if deferred:
+                    await interaction.response.defer()
+                acked = time.perf_counter()
+                result = await work
                 
-                # فحص الشروط
-                requirements = choice.get("require", {})
-                for var, min_val in requirements.items():
-                    if var == "flag":
-                        if self.bot.db.get_flag(self.user_id, min_val) == 0:
-                            await interaction.followup.send(f"⚠️ لا يمكنك اختيار هذا المسار بعد.", ephemeral=True)
-                            return
+                if "error" in result:
+                    if deferred:
+                        await interaction.followup.send(result["error"], ephemeral=True)
                     else:
-                        if player.get(var, 0) < min_val:
-                            await interaction.followup.send(
-                                f"⚠️ **متطلب ناقص!** تحتاج إلى `{min_val}` من نقاط `{var}` لاختيار هذا المسار.",
-                                ephemeral=True
-                            )
-                            return
-                
-                # نظام الاحتمالات
-                success = random.randint(1, 100) <= choice.get("chance", 100)
-                next_id = choice.get("next") if success else choice.get("fail_next", choice.get("next"))
-                effects = choice.get("effects" if success else "fail_effects", {})
-                
-                # التحقق من وجود الجزء التالي قبل تحديث قاعدة البيانات
-                next_part = self.bot.story_loader.get_part(next_id)
-                if next_id is None or next_part is None:
-                    logger.error(f"Missing next part referenced: {next_id} from {self.part_data.get('id')}")
-                    await interaction.followup.send(
-                        f"⚠️ خطأ في القصة: الجزء `{next_id}` غير معرف. سيتم إبلاغ المطور.",
-                        ephemeral=True
-                    )
+                        await interaction.response.send_message(result["error"], ephemeral=True)
+                    self._log_click(choice, result["result"], started, mode="deferred" if deferred else "fast")
                     return
                 
-                updates = {"current_part": next_id}
-                impact_log = []
-                
-                for var, val in effects.items():
-                    if var == "achievement":
-                        if self.bot.db.unlock_achievement(self.user_id, val):
-                            ach = self.bot.story_loader.get_achievement_info(val)
-                            await interaction.followup.send(f"🏆 **إنجاز جديد:** {ach['emoji']} {ach['name']}", ephemeral=True)
-                        continue
-                    
-                    if var == "inventory_add":
-                        if isinstance(val, dict):
-                            item_id = val.get("id", "unknown")
-                            item_name = val.get("name", item_id)
-                            qty = val.get("qty", 1)
-                            self.bot.db.add_to_inventory(self.user_id, item_id, item_name, qty)
-                            impact_log.append(f"حصلت على {item_name} x{qty}")
-                        else:
-                            self.bot.db.add_to_inventory(self.user_id, val, val)
-                            impact_log.append(f"حصلت على {val}")
-                        continue
-                    
-                    if var == "inventory_remove":
-                        if isinstance(val, dict):
-                            item_id = val.get("id")
-                            qty = val.get("qty", 1)
-                            self.bot.db.remove_from_inventory(self.user_id, item_id, qty)
-                            impact_log.append(f"فقدت {item_id} x{qty}")
-                        else:
-                            self.bot.db.remove_from_inventory(self.user_id, val)
-                            impact_log.append(f"فقدت {val}")
-                        continue
-                    
-                    if var == "flag":
-                        self.bot.db.set_flag(self.user_id, val, 1)
-                        impact_log.append(f"علم: {val}")
-                        continue
-                    
-                    if var == "relationship":
-                        if ':' in val:
-                            char, change = val.split(':', 1)
-                            try:
-                                change = int(change)
-                                self.bot.db.set_flag(self.user_id, f"rel_{char}", change)
-                                impact_log.append(f"علاقة {char}: {change:+}")
-                            except:
-                                pass
-                        continue
-                    
-                    # متغيرات نصية
-                    if var in ["alignment", "dragon_alliance", "rival_status"]:
-                        updates[var] = val
-                        impact_log.append(f"{var} = {val}")
-                    else:
-                        # متغيرات رقمية
-                        current = player.get(var, 0)
-                        new_val = current + val
-                        # حدود خاصة
-                        if var == "corruption":
-                            new_val = GameUI.clamp(new_val, 0, 100)
-                        elif var == "mystery":
-                            new_val = GameUI.clamp(new_val, 0, 100)
-                        elif var == "world_stability":
-                            new_val = GameUI.clamp(new_val, 0, 100)
-                        elif var == "reputation":
-                            new_val = GameUI.clamp(new_val, -50, 50)
-                        elif var == "trust_aren":
-                            new_val = GameUI.clamp(new_val, 0, 100)
-                        elif var == "knowledge_path":
-                            new_val = GameUI.clamp(new_val, 0, 100)
-                        elif var == "shards":
-                            new_val = max(0, new_val)
-                        else:
-                            new_val = max(0, new_val)
-                        updates[var] = new_val
-                        impact_log.append(f"{var}: {val:+}")
-                
-                xp_gain = random.randint(10, 20)
-                updates["xp"] = player.get("xp", 0) + xp_gain
-                impact_log.append(f"XP: +{xp_gain}")
-                
-                if updates["xp"] >= 100:
-                    updates["xp"] = updates["xp"] - 100
-                    updates["level"] = player.get("level", 1) + 1
-                    impact_log.append(f"⬆️ مستوى {updates['level']}!")
-                
-                self.bot.db.update_player(self.user_id, updates)
-                impact_summary = ", ".join(impact_log) if impact_log else "لا تأثير"
-                self.bot.db.add_history(self.user_id, self.part_data['id'], choice.get('text', ''), impact_summary)
+                success = result["success"]
+                message = {
+                    "content": "✅ تم تنفيذ قرارك!" if success else "⚠️ فشلت المحاولة وتغير المسار!",
+                    "embed": result["embed"],
+                    "view": StoryView(self.bot, self.user_id, result["next_part"]),
+                }
+                if deferred:
+                    await interaction.message.edit(**message)
+                else:
+                    await interaction.response.edit_message(**message)
+                    acked = time.perf_counter()
                 
-                # تحديث اللاعب بعد التغييرات
-                updated_player = self.bot.db.get_player(self.user_id)
-                embed = self.bot.create_game_embed(next_part, updated_player)
+                for ach_id, unlock in result["unlocked"]:
+                    ach = self.bot.story_loader.get_achievement_info(ach_id)
+                    await interaction.followup.send(f"🏆 **إنجاز جديد:** {ach['emoji']} {ach['name']}", ephemeral=True)
+                    if unlock["server_first"]:
+                        await interaction.followup.send(
+                            f"🥇 {interaction.user.mention} أول مغامر يفتح إنجاز {ach['emoji']} **{ach['name']}**!"
+                        )
                 
-                # تعديل الرسالة الأصلية مباشرة
-                await interaction.message.edit(
-                    content="✅ تم تنفيذ قرارك!" if success else "⚠️ فشلت المحاولة وتغير المسار!",
-                    embed=embed,
-                    view=StoryView(self.bot, self.user_id, next_part)
+                self._log_click(
+                    choice, "ok", started,
+                    success=success,
+                    mode="deferred" if deferred else "fast",
+                    ack_ms=round((acked - started) * 1000, 1),
                 )
             
             except Exception as e:
-                logger.error(f"خطأ في معالجة الزر: {e}", exc_info=True)
+                logger.error("خطأ في معالجة الزر: %s", e, exc_info=True)
+                self._log_click(choice, "error", started)
                 try:
-                    await interaction.followup.send(f"❌ حدث خطأ: {str(e)}", ephemeral=True)
+                    if interaction.response.is_done():
+                        await interaction.followup.send(f"❌ حدث خطأ: {str(e)}", ephemeral=True)
+                    else:
+                        await interaction.response.send_message(f"❌ حدث خطأ: {str(e)}", ephemeral=True)
                 except:
                     pass
+            finally:
+                lock.release()
+                admission.release(interaction)
         
         return callback
 
+# ============================================
+# الوضع الجماعي (Party Mode)
+# ============================================
+PARTY_VOTE_SECONDS = int(os.getenv("PARTY_VOTE_SECONDS", "30"))
+PARTY_EDIT_DEBOUNCE = float(os.getenv("PARTY_EDIT_DEBOUNCE", "2.0"))  # ثوانٍ بين تحديثات عرض الأصوات
+
+class PartyView(discord.ui.View):
+    """قصة مشتركة لمجموعة: كل نقرة صوت يُجمع في الذاكرة، وعند انتهاء المهلة أو بلوغ النصاب
+    يُطبق الخيار الفائز على كل الأعضاء في معاملة واحدة وبتعديل واحد للرسالة.
+    الانضمام صريح بزر، ويحفظ الحالة الفردية للعضو في خانة PARTY_SLOT قبل أن تغيرها المجموعة"""
+    
+    _live: set = set()  # الجلسات الجارية (الجولة الحالية لكل مجموعة)
+    
+    @classmethod
+    def in_live_party(cls, user_id: int) -> bool:
+        return any(user_id in view.members for view in cls._live)
+    
+    @classmethod
+    def checkpoint(cls, db: "Database", user_id: int):
+        """حفظ الحالة الفردية قبل الرحلة، إلا إن كان اللاعب في رحلة أخرى (حالته الحالية ليست فردية)"""
+        if not cls.in_live_party(user_id):
+            db.save_slot(user_id, PARTY_SLOT)
+    
+    def stop(self):
+        PartyView._live.discard(self)
+        super().stop()
+    
+    def __init__(self, bot, leader_id: int, part_data: Dict, members: Optional[set] = None,
+                 vote_seconds: int = PARTY_VOTE_SECONDS, quorum: Optional[int] = None):
+        super().__init__(timeout=None)
+        self.bot = bot
+        self.leader_id = leader_id
+        self.part_data = part_data
+        self.members = set(members or {leader_id})
+        self.vote_seconds = vote_seconds
+        self.quorum = quorum
+        self.votes: Dict[int, int] = {}
+        # الجزء الذي كان فيه كل عضو عند انضمامه (الأعضاء المنقولون من الجولة السابقة في هذا الجزء)
+        self.positions: Dict[int, str] = {}
+        self.message: Optional[discord.Message] = None
+        self._round_task: Optional[asyncio.Task] = None
+        self._edit_task: Optional[asyncio.Task] = None
+        self._resolve_task: Optional[asyncio.Task] = None
+        self._resolving = False
+        self._setup_buttons()
+        PartyView._live.add(self)
+    
+    def _setup_buttons(self):
+        for i, choice in enumerate(self.part_data.get("choices", [])):
+            btn = discord.ui.Button(
+                label=choice.get("text", f"خيار {i+1}")[:80],
+                custom_id=f"p_{self.part_data['id']}_{i}_{self.leader_id}",
+                emoji=choice.get("emoji"),
+                style=GameUI.choice_button_style(choice)
+            )
+            btn.callback = self._create_callback(i)
+            self.add_item(btn)
+        
+        join = discord.ui.Button(label="انضمام", emoji="👥", style=discord.ButtonStyle.success,
+                                 custom_id=f"pj_{self.part_data['id']}_{self.leader_id}", row=4)
+        join.callback = self._join
+        leave = discord.ui.Button(label="مغادرة", emoji="🚪", style=discord.ButtonStyle.secondary,
+                                  custom_id=f"pl_{self.part_data['id']}_{self.leader_id}", row=4)
+        leave.callback = self._leave
+        self.add_item(join)
+        self.add_item(leave)
+    
+    def embed(self) -> discord.Embed:
+        return self.bot.create_party_embed(self.part_data, self.votes, len(self.members))
+    
+    def _schedule_edit(self):
+        if self._edit_task is None or self._edit_task.done():
+            self._edit_task = asyncio.create_task(self._debounced_edit())
+    
+    async def _join(self, interaction: discord.Interaction):
+        user_id = interaction.user.id
+        if user_id in self.members:
+            await interaction.response.send_message("✅ أنت في المجموعة بالفعل.", ephemeral=True)
+            return
+        if self._resolving:
+            await interaction.response.send_message("⏳ يتم احتساب الأصوات، انضم في الجزء التالي.", ephemeral=True)
+            return
+        if not await admission.admit(interaction, "party_join"):
+            return
+        try:
+            # قرارات المجموعة ستغير تقدم العضو الفردي، لذا تُحفظ حالته أولاً
+            player = self.bot.db.get_or_create_players([user_id])[user_id]
+            PartyView.checkpoint(self.bot.db, user_id)
+            self.positions[user_id] = player.get('current_part')
+            self.members.add(user_id)
+            if self.message is None:
+                self.message = interaction.message
+            await interaction.response.send_message(
+                "👥 انضممت للرحلة! قرارات المجموعة ستُطبق على تقدمك.\n"
+                f"👥 حالتك الفردية قبل الرحلة محفوظة، استعدها بـ `/تحميل الخانة:{PARTY_SLOT}`.",
+                ephemeral=True
+            )
+            self._schedule_edit()
+        finally:
+            admission.release(interaction)
+    
+    async def _leave(self, interaction: discord.Interaction):
+        user_id = interaction.user.id
+        if user_id == self.leader_id:
+            await interaction.response.send_message("👑 قائد المجموعة لا يستطيع المغادرة.", ephemeral=True)
+            return
+        if user_id not in self.members:
+            await interaction.response.send_message("❌ لست عضواً في هذه المجموعة.", ephemeral=True)
+            return
+        if self._resolving:
+            await interaction.response.send_message("⏳ يتم احتساب الأصوات، غادر بعد ظهور الجزء التالي.", ephemeral=True)
+            return
+        self.members.discard(user_id)
+        self.positions.pop(user_id, None)
+        self.votes.pop(user_id, None)
+        await interaction.response.send_message("🚪 غادرت الرحلة الجماعية.", ephemeral=True)
+        if self.message is None:
+            self.message = interaction.message
+        self._schedule_edit()
+    
+    def _create_callback(self, index: int):
+        async def callback(interaction: discord.Interaction):
+            if self._resolving:
+                await interaction.response.send_message("⏳ يتم احتساب الأصوات، انتظر الجزء التالي.", ephemeral=True)
+                return
+            if interaction.user.id not in self.members:
+                await interaction.response.send_message("👥 اضغط «انضمام» أولاً للمشاركة في التصويت.", ephemeral=True)
+                return
+            if not await admission.admit(interaction, "vote", db=False):
+                return
+            
+            # التصويت في الذاكرة فقط؛ لا قاعدة بيانات ولا تعديل فوري للرسالة
+            self.votes[interaction.user.id] = index
+            await interaction.response.defer()
+            if self.message is None:
+                self.message = interaction.message
+            
+            if self.quorum and len(self.votes) >= self.quorum:
+                if self._resolve_task is None:
+                    self._resolve_task = asyncio.create_task(self.resolve())
+                return
+            if self._round_task is None:
+                self._round_task = asyncio.create_task(self._round_timer())
+            self._schedule_edit()
+        
+        return callback
+    
+    async def _round_timer(self):
+        await asyncio.sleep(self.vote_seconds)
+        await self.resolve()
+    
+    async def _debounced_edit(self):
+        await asyncio.sleep(PARTY_EDIT_DEBOUNCE)
+        if self._resolving:
+            return
+        try:
+            await self.message.edit(embed=self.embed(), view=self)
+        except discord.HTTPException as e:
+            logger.warning(f"⚠️ تعذر تحديث أصوات الجلسة الجماعية: {e}")
+    
+    def _pick_winner(self, leader: Dict) -> Optional[int]:
+        """الخيار الأكثر أصواتاً (التعادل يُحسم عشوائياً)، مع استبعاد ما لا يستوفي القائد شروطه"""
+        choices = self.part_data.get("choices", [])
+        tally = Counter(self.votes.values())
+        ranked = sorted(tally, key=lambda i: (tally[i], random.random()), reverse=True)
+        for index in ranked:
+            if self.bot.engine.check_requirements(leader, choices[index]) is None:
+                return index
+        return None
+    
+    def _resolve_round(self, members: List[int]) -> Dict:
+        """عمل قاعدة البيانات للجولة (يعمل في خيط عامل): يعيد {"error": ...} أو نتيجة الجولة"""
+        players = self.bot.db.get_or_create_players(members)
+        # من تقدم بنقرة فردية منذ انضمامه لم يعد في موضع المجموعة، فلا يُطبق عليه قرارها
+        drifted = {uid for uid in members
+                   if players[uid].get('current_part') != self.positions.get(uid, self.part_data['id'])}
+        if self.leader_id in drifted:
+            return {"error": "⚠️ تقدم قائد المجموعة منفرداً، انتهت الرحلة الجماعية."}
+        members = [uid for uid in members if uid not in drifted]
+        index = self._pick_winner(players[self.leader_id])
+        if index is None:
+            return {"error": "⚠️ لا يستوفي قائد المجموعة شروط أي خيار حصل على أصوات."}
+        choice = self.part_data["choices"][index]
+        
+        # الشروط تُفحص لكل عضو؛ من لا يستوفيها يخرج من المجموعة ويبقى تقدمه كما هو
+        qualified = [uid for uid in members if self.bot.engine.check_requirements(players[uid], choice) is None]
+        
+        success, next_id, effects = self.bot.engine.roll(choice)
+        next_part = self.bot.story_loader.get_part(next_id)
+        if next_id is None or next_part is None:
+            logger.error("Missing next part referenced: %s from %s", next_id, self.part_data.get('id'))
+            return {"error": f"⚠️ خطأ في القصة: الجزء `{next_id}` غير معرف."}
+        
+        outcomes = [
+            self.bot.engine.build_outcome(players[uid], self.part_data['id'], choice, effects, next_id)
+            for uid in qualified
+        ]
+        return {
+            "index": index,
+            "choice": choice,
+            "success": success,
+            "next_part": next_part,
+            "members": set(qualified),
+            "drifted": drifted,
+            "unlocked": self.bot.db.apply_choice_outcomes(outcomes),
+        }
+    
+    async def resolve(self):
+        if self._resolving:
+            return
+        if not self.votes:
+            # كل المصوتين غادروا: الجولة تبدأ من جديد مع أول صوت
+            self._round_task = None
+            self._schedule_edit()
+            return
+        self._resolving = True
+        current = asyncio.current_task()
+        for task in (self._round_task, self._edit_task):
+            if task and task is not current and not task.done():
+                task.cancel()
+        
+        # أقفال النقرات الفردية للأعضاء: لا تتداخل كتابة المجموعة مع نقرة فردية جارية
+        members = sorted(self.members)
+        locks = [_click_locks.setdefault(uid, asyncio.Lock()) for uid in members]
+        for lock in locks:
+            await lock.acquire()
+        try:
+            result = await asyncio.to_thread(self._resolve_round, members)
+            if "error" in result:
+                await self.message.edit(content=result["error"], view=None)
+                return
+            
+            index, choice = result["index"], result["choice"]
+            skipped = self.members - result["members"] - result["drifted"]
+            self.members = result["members"]
+            content = (f"🗳️ اختارت المجموعة: **{choice.get('text', '')}** "
+                       f"({Counter(self.votes.values())[index]}/{len(self.votes)} صوت)")
+            if not result["success"]:
+                content += "\n⚠️ فشلت المحاولة وتغير المسار!"
+            if skipped:
+                content += f"\n⛔ لا يستوفي شروط هذا الخيار فغادر المجموعة: {' '.join(f'<@{uid}>' for uid in skipped)}"
+            if result["drifted"]:
+                content += f"\n🚶 تقدم منفرداً فغادر المجموعة: {' '.join(f'<@{uid}>' for uid in result['drifted'])}"
+            new_achievements = Counter(ach_id for results in result["unlocked"].values() for ach_id, _ in results)
+            for ach_id, count in new_achievements.items():
+                ach = self.bot.story_loader.get_achievement_info(ach_id)
+                content += f"\n🏆 {ach['emoji']} **{ach['name']}** لـ {count} مغامر"
+            
+            next_view = PartyView(self.bot, self.leader_id, result["next_part"], self.members, self.vote_seconds, self.quorum)
+            next_view.message = self.message
+            await self.message.edit(content=content, embed=next_view.embed(), view=next_view)
+        except Exception as e:
+            logger.error("خطأ في الجلسة الجماعية: %s", e, exc_info=True)
+            try:
+                await self.message.edit(content="❌ حدث خطأ أثناء احتساب الأصوات، انتهت الرحلة الجماعية.", view=None)
+            except discord.HTTPException:
+                pass
+        finally:
+            for lock in locks:
+                lock.release()
+            self.stop()
+
 # ============================================
 # أوامر الس slash (نفسها مع إضافة المتغير knowledge_path)
 # ============================================
@@ -653,24 +2234,26 @@ async def start(interaction: discord.Interaction):
         reset_btn = discord.ui.Button(label="🔄 ابدأ من جديد", style=discord.ButtonStyle.danger)
         
         async def continue_callback(interaction: discord.Interaction):
-            await continue_game(interaction)
+            if not await admission.admit(interaction, "استمر"):
+                return
+            try:
+                await continue_game.callback(interaction)
+            finally:
+                admission.release(interaction)
         
         async def reset_callback(interaction: discord.Interaction):
-            conn = sqlite3.connect(bot.db.db_file, timeout=10)
-            c = conn.cursor()
-            c.execute("DELETE FROM players WHERE user_id = ?", (user_id,))
-            c.execute("DELETE FROM achievements WHERE user_id = ?", (user_id,))
-            c.execute("DELETE FROM inventory WHERE user_id = ?", (user_id,))
-            c.execute("DELETE FROM flags WHERE user_id = ?", (user_id,))
-            c.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
-            conn.commit()
-            conn.close()
-            bot.db.create_player(user_id)
-            part = bot.story_loader.get_part("PART_01")
-            player = bot.db.get_player(user_id)
-            embed = bot.create_game_embed(part, player)
-            view = StoryView(bot, user_id, part)
-            await interaction.response.edit_message(content="✅ تمت إعادة التعيين. ابدأ رحلتك!", embed=embed, view=view)
+            if not await admission.admit(interaction, "إعادة"):
+                return
+            try:
+                bot.db.reset_player(user_id)
+                bot.db.create_player(user_id)
+                part = bot.story_loader.get_part("PART_01")
+                player = bot.db.get_player(user_id)
+                embed = bot.create_game_embed(part, player)
+                view = StoryView(bot, user_id, part)
+                await interaction.response.edit_message(content="✅ تمت إعادة التعيين. ابدأ رحلتك!", embed=embed, view=view)
+            finally:
+                admission.release(interaction)
         
         continue_btn.callback = continue_callback
         reset_btn.callback = reset_callback
@@ -743,6 +2326,27 @@ async def profile(interaction: discord.Interaction):
     
     await interaction.response.send_message(embed=embed)
 
+@bot.tree.command(name="شخصيتي", description="🧠 اعرض ملف شخصيتك المبني على قراراتك")
+async def personality(interaction: discord.Interaction):
+    user_id = interaction.user.id
+    player = bot.db.get_player(user_id)
+    if not player:
+        await interaction.response.send_message("❌ ابدأ مغامرتك أولاً.", ephemeral=True)
+        return
+    
+    traits = Database.unpack_map(player.get('traits'))
+    ranked = sorted(((t, v) for t, v in traits.items() if v > 0), key=lambda tv: tv[1], reverse=True)
+    embed = discord.Embed(title=f"🧠 شخصية {interaction.user.name}", color=discord.Color.purple())
+    if not ranked:
+        embed.description = "لم تتشكل ملامح شخصيتك بعد. قراراتك القادمة ستكشفها."
+    else:
+        top = ranked[0][1]
+        dominant = " • ".join(f"**{TRAIT_NAMES.get(t, t)}**" for t, _ in ranked[:3])
+        embed.description = f"السمات الغالبة: {dominant}"
+        lines = [f"`{TRAIT_NAMES.get(t, t)}` {GameUI.create_progress_bar(v, top, 8)}" for t, v in ranked[:8]]
+        embed.add_field(name="📊 السمات", value="\n".join(lines), inline=False)
+    await interaction.response.send_message(embed=embed)
+
 @bot.tree.command(name="مخزني", description="🎒 اعرض محتويات مخزونك")
 async def inventory(interaction: discord.Interaction):
     user_id = interaction.user.id
@@ -819,10 +2423,11 @@ async def achievements(interaction: discord.Interaction):
     embed = discord.Embed(title=f"🏆 إنجازات {interaction.user.name}", color=discord.Color.gold())
     lines = []
     for ach_id, ach_data in achievements_data.items():
+        rarity = f"فتحه {bot.db.get_achievement_rarity(ach_id):.1f}% من اللاعبين"
         if ach_id in unlocked:
-            lines.append(f"✅ {ach_data.get('emoji', '🏆')} **{ach_data.get('name', ach_id)}**\n└ {ach_data.get('description', '')}")
+            lines.append(f"✅ {ach_data.get('emoji', '🏆')} **{ach_data.get('name', ach_id)}**\n└ {ach_data.get('description', '')} • {rarity}")
         else:
-            lines.append(f"❌ {ach_data.get('emoji', '🏆')} ~~{ach_data.get('name', ach_id)}~~")
+            lines.append(f"❌ {ach_data.get('emoji', '🏆')} ~~{ach_data.get('name', ach_id)}~~ • {rarity}")
     embed.description = "\n\n".join(lines) if lines else "لا توجد إنجازات محددة."
     await interaction.response.send_message(embed=embed)
 
@@ -886,17 +2491,14 @@ async def reset(interaction: discord.Interaction):
     cancel = discord.ui.Button(label="❌ لا، تراجع", style=discord.ButtonStyle.secondary)
     
     async def confirm_callback(interaction: discord.Interaction):
+        if not await admission.admit(interaction, "إعادة"):
+            return
         user_id = interaction.user.id
-        conn = sqlite3.connect(bot.db.db_file, timeout=10)
-        c = conn.cursor()
-        c.execute("DELETE FROM players WHERE user_id = ?", (user_id,))
-        c.execute("DELETE FROM achievements WHERE user_id = ?", (user_id,))
-        c.execute("DELETE FROM inventory WHERE user_id = ?", (user_id,))
-        c.execute("DELETE FROM flags WHERE user_id = ?", (user_id,))
-        c.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
-        conn.commit()
-        conn.close()
-        await interaction.response.edit_message(content="✅ تم حذف تقدمك بالكامل. استخدم /ابدأ لبدء رحلة جديدة.", embed=None, view=None)
+        try:
+            bot.db.reset_player(user_id)
+        finally:
+            admission.release(interaction)
+        await interaction.response.edit_message(content="✅ تم حذف تقدمك بالكامل. استخدم /ابدأ لبدء رحلة جديدة، أو `/تحميل 0` للتراجع.", embed=None, view=None)
     
     async def cancel_callback(interaction: discord.Interaction):
         await interaction.response.edit_message(content="❌ تم إلغاء الأمر.", embed=None, view=None)
@@ -913,6 +2515,68 @@ async def reset(interaction: discord.Interaction):
     )
     await interaction.response.send_message(embed=embed, view=view)
 
+@bot.tree.command(name="حفظ", description="💾 احفظ تقدمك الحالي في خانة")
+@app_commands.describe(الخانة=f"رقم خانة الحفظ (1-{SAVE_SLOTS})")
+async def save_game(interaction: discord.Interaction, الخانة: app_commands.Range[int, 1, SAVE_SLOTS]):
+    user_id = interaction.user.id
+    if not bot.db.save_slot(user_id, الخانة):
+        await interaction.response.send_message("❌ لا يوجد تقدم لحفظه. ابدأ بـ /ابدأ", ephemeral=True)
+        return
+    await interaction.response.send_message(f"💾 تم حفظ تقدمك في الخانة {الخانة}.", ephemeral=True)
+
+@bot.tree.command(name="تحميل", description="📂 استرجع تقدماً محفوظاً")
+@app_commands.describe(الخانة=f"رقم خانة الحفظ (1-{SAVE_SLOTS})، أو 0 للنسخة قبل آخر إعادة تعيين، أو {PARTY_SLOT} لما قبل الرحلة الجماعية")
+async def load_game(interaction: discord.Interaction, الخانة: Optional[app_commands.Range[int, 0, PARTY_SLOT]] = None):
+    user_id = interaction.user.id
+    if الخانة is None:
+        slots = bot.db.get_save_slots(user_id)
+        if not slots:
+            await interaction.response.send_message("📂 لا توجد خانات محفوظة بعد. استخدم /حفظ", ephemeral=True)
+            return
+        desc = ""
+        for s in slots:
+            if s['slot'] == AUTOSAVE_SLOT:
+                name = "🔄 تلقائية"
+            elif s['slot'] == PARTY_SLOT:
+                name = f"👥 الخانة {PARTY_SLOT} (قبل الرحلة الجماعية)"
+            else:
+                name = f"💾 الخانة {s['slot']}"
+            desc += f"**{name}** • `{s['part_id']}` • {s['saved_at'][:16].replace('T', ' ')}\n"
+        embed = discord.Embed(title="📂 خانات الحفظ", description=desc, color=discord.Color.blue())
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
+    
+    if not bot.db.load_slot(user_id, الخانة):
+        await interaction.response.send_message("❌ هذه الخانة فارغة.", ephemeral=True)
+        return
+    player = bot.db.get_player(user_id)
+    part = bot.story_loader.get_part(player.get("current_part", "PART_01")) or bot.story_loader.get_part("PART_01")
+    embed = bot.create_game_embed(part, player)
+    view = StoryView(bot, user_id, part)
+    await interaction.response.send_message(content=f"📂 تم تحميل الخانة {الخانة}.", embed=embed, view=view)
+
+@bot.tree.command(name="جماعي", description="👥 ابدأ رحلة جماعية يصوت فيها الجميع على القرار")
+@app_commands.describe(
+    المهلة="مدة التصويت لكل جزء بالثواني",
+    النصاب="عدد الأصوات الذي يحسم القرار فوراً (اختياري)"
+)
+async def party(interaction: discord.Interaction,
+                المهلة: app_commands.Range[int, 10, 300] = PARTY_VOTE_SECONDS,
+                النصاب: Optional[app_commands.Range[int, 1, 50]] = None):
+    user_id = interaction.user.id
+    player = bot.db.get_player(user_id)
+    if not player:
+        bot.db.create_player(user_id)
+        player = bot.db.get_player(user_id)
+    part = bot.story_loader.get_part(player.get("current_part", "PART_01")) or bot.story_loader.get_part("PART_01")
+    PartyView.checkpoint(bot.db, user_id)
+    view = PartyView(bot, user_id, part, vote_seconds=المهلة, quorum=النصاب)
+    await interaction.response.send_message(
+        content=f"👥 {interaction.user.mention} بدأ رحلة جماعية! اضغط «انضمام» ثم صوّت على خيار.",
+        embed=view.embed(),
+        view=view
+    )
+
 @bot.tree.command(name="خريطة", description="🗺️ اعرض خريطة العالم")
 async def map_command(interaction: discord.Interaction):
     user_id = interaction.user.id
@@ -921,25 +2585,32 @@ async def map_command(interaction: discord.Interaction):
         await interaction.response.send_message("❌ ابدأ مغامرتك أولاً.", ephemeral=True)
         return
     
-    location = player.get('location', 'أنقاض')
-    map_text = """
-    ```
-    [🌌] العالم الخارجي
-       |
-    [🏰] المدينة القديمة
-       |
-    [🌲] الغابة المسحورة
-       |
-    [🏜️] الصحراء المنسية
-       |
-    [💎] عالم الكريستال
-       |
-    [🌑] عالم الظل
-    ```
-    أنت الآن في: **{}**
-    """.format(location)
-    
-    embed = discord.Embed(title="🗺️ خريطة العوالم", description=map_text, color=discord.Color.green())
+    current_part = bot.story_loader.get_part(player.get('current_part', 'PART_01')) or {}
+    location = current_part.get('location') or player.get('location', 'أنقاض')
+    visited = bot.db.visited_locations(player) | {location}
+    graph = bot.story_loader.location_graph
+    
+    # المواقع المزارة فقط بأسمائها، وغير المزارة تبقى مجهولة
+    lines = []
+    for name in bot.story_loader.locations:
+        if name not in visited:
+            continue
+        marker = "📍" if name == location else "✅"
+        exits = graph.get(name, [])
+        known = [n for n in exits if n in visited]
+        unknown = len(exits) - len(known)
+        route = "، ".join(known)
+        if unknown:
+            route += f"{'، ' if route else ''}❔×{unknown}"
+        lines.append(f"{marker} **{name}**" + (f"\n└ ➜ {route}" if route else ""))
+    
+    total = len(bot.story_loader.locations)
+    desc = "\n".join(lines)
+    if len(desc) > 3800:
+        desc = desc[:3800].rsplit("\n", 1)[0] + "\n…"
+    embed = discord.Embed(title="🗺️ خريطة العوالم", description=desc, color=discord.Color.green())
+    embed.add_field(name="📍 موقعك الحالي", value=location, inline=True)
+    embed.add_field(name="🧭 الاستكشاف", value=f"{len(visited & set(graph))}/{total} موقع", inline=True)
     await interaction.response.send_message(embed=embed)
 
 @bot.tree.command(name="مساعدة", description="📚 عرض المساعدة وشرح الأوامر")
@@ -953,12 +2624,16 @@ async def help_command(interaction: discord.Interaction):
         "**/ابدأ** - ابدأ رحلة جديدة\n"
         "**/استمر** - استمر في رحلتك\n"
         "**/حالتي** - اعرض إحصائياتك\n"
+        "**/شخصيتي** - اعرض ملف شخصيتك\n"
         "**/مخزني** - اعرض محتويات مخزونك\n"
         "**/استخدم** - استخدم عنصراً (مثل جرعة)\n"
         "**/إنجازاتي** - اعرض الإنجازات\n"
         "**/تاريخي** - اعرض تاريخ قراراتك\n"
         "**/يومي** - احصل على مكافأة يومية\n"
         "**/خريطة** - اعرض خريطة العالم\n"
+        "**/جماعي** - رحلة جماعية بالتصويت\n"
+        "**/حفظ** - احفظ تقدمك في خانة\n"
+        "**/تحميل** - استرجع تقدماً محفوظاً\n"
         "**/إعادة** - ابدأ من جديد (احذر!)\n"
         "**/مساعدة** - عرض هذه المساعدة"
     )
@@ -970,6 +2645,87 @@ async def help_command(interaction: discord.Interaction):
     )
     await interaction.response.send_message(embed=embed)
 
+# ============================================
+# أوامر الإدارة (Admin)
+# ============================================
+async def ensure_owner(interaction: discord.Interaction) -> bool:
+    if await bot.is_owner(interaction.user):
+        return True
+    await interaction.response.send_message("⛔ هذا الأمر لمالك البوت فقط.", ephemeral=True)
+    return False
+
+@bot.tree.command(name="ترحيل_القصة", description="🛠️ (للمالك) تحويل معرفات الأجزاء القديمة لكل اللاعبين")
+@app_commands.describe(تطبيق="نفذ التحويل فعلاً؛ بدونه يُعرض تقرير تجريبي فقط")
+async def migrate_story(interaction: discord.Interaction, تطبيق: bool = False):
+    if not await ensure_owner(interaction):
+        return
+    try:
+        migration = bot.story_loader.load_migrations(STORY_MIGRATIONS_FILE)
+    except ValueError as e:
+        await interaction.response.send_message(f"❌ ملف التحويل غير صالح: {e}", ephemeral=True)
+        return
+    if not migration or not migration.get("mappings"):
+        await interaction.response.send_message(f"📭 لا توجد تحويلات في `{STORY_MIGRATIONS_FILE}`.", ephemeral=True)
+        return
+    
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    version = str(migration.get("version") or "—")
+    mappings = migration["mappings"]
+    # التقرير والتطبيق يعملان في خيط منفصل حتى لا تتوقف حلقة الأحداث
+    report = await asyncio.to_thread(bot.db.preview_part_remap, mappings)
+    lines = [f"`{old}` → `{mappings[old]}`: 👤 {r['players']} • 📜 {r['history']}" for old, r in report.items()]
+    embed = discord.Embed(title=f"🛠️ ترحيل القصة (الإصدار {version})", description="\n".join(lines)[:4000], color=discord.Color.orange())
+    
+    if migration["errors"]:
+        embed.add_field(name="❌ أخطاء", value="\n".join(migration["errors"])[:1024], inline=False)
+    elif تطبيق:
+        result = await asyncio.to_thread(bot.db.apply_part_remap, version, mappings)
+        if result is None:
+            embed.add_field(name="⏭️ تم التخطي", value="هذا الإصدار مطبق مسبقاً أو قيد التطبيق.", inline=False)
+        else:
+            embed.color = discord.Color.green()
+            embed.add_field(name="✅ تم التطبيق", value=f"👤 {result['players']} لاعب • 📜 {result['history']} صف من السجل", inline=False)
+            logger.info(f"✅ ترحيل القصة {version}: {result}")
+    else:
+        embed.set_footer(text="تقرير تجريبي — أعد الأمر مع تطبيق=True للتنفيذ")
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="تحليل_الأداء", description="🩺 (للمالك) شغّل محلل الأداء لعدد من الثواني")
+@app_commands.describe(الثواني="مدة أخذ العينات", العدد="عدد الدوال في الملخص")
+async def profile_command(interaction: discord.Interaction,
+                          الثواني: app_commands.Range[int, 1, PROFILE_MAX_SECONDS] = 10,
+                          العدد: app_commands.Range[int, 5, 40] = 15):
+    if not await ensure_owner(interaction):
+        return
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    if not profiler.ready:
+        await interaction.followup.send("⏳ البوت ما زال يبدأ، محلل الأداء غير جاهز بعد.", ephemeral=True)
+        return
+    stacks = await asyncio.to_thread(profiler.run, الثواني)
+    if stacks is None:
+        await interaction.followup.send("⏳ محلل الأداء يعمل بالفعل.", ephemeral=True)
+        return
+    summary = SamplingProfiler.summary(stacks, العدد)
+    collapsed = io.BytesIO(SamplingProfiler.collapsed(stacks).encode('utf-8'))
+    await interaction.followup.send(
+        content=f"```\n{summary[:1900]}\n```",
+        file=discord.File(collapsed, filename=f"profile_{datetime.now():%Y%m%d_%H%M%S}.collapsed.txt"),
+        ephemeral=True
+    )
+
+@bot.tree.command(name="إحصائيات_القبول", description="🚦 (للمالك) عدادات قبول ورفض الطلبات")
+async def admission_stats(interaction: discord.Interaction):
+    if not await ensure_owner(interaction):
+        return
+    stats = admission.stats()
+    lines = [
+        f"`{key}` ✅ {c['admitted']} • 🐢 {c['rejected_rate']} • ⏳ {c['rejected_busy']}"
+        for key, c in sorted(stats["commands"].items(), key=lambda kv: kv[1]["admitted"], reverse=True)
+    ]
+    embed = discord.Embed(title="🚦 التحكم في القبول", description="\n".join(lines)[:4000] or "لا توجد طلبات بعد.", color=discord.Color.blurple())
+    embed.set_footer(text=f"عمليات جارية: {stats['db_inflight']}/{admission.max_db_inflight} • دلاء: {stats['buckets']}")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
 # ============================================
 # حدث اتصال البوت
 # ============================================
@@ -987,7 +2743,8 @@ if __name__ == "__main__":
     TOKEN = os.getenv('TOKEN')
     if TOKEN:
         try:
-            bot.run(TOKEN)
+            # log_handler=None: سجلات discord.py تمر عبر طابور السجل بدلاً من StreamHandler خاص بها
+            bot.run(TOKEN, log_handler=None)
         except Exception as e:
             logger.critical(f"🚨 خطأ في تشغيل البوت: {e}")
     else: